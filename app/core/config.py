@@ -86,6 +86,11 @@ class Settings(BaseSettings):
 
     # If you change this, also change in alembic.ini
     db_file: str = "sqlite:///./flux-restful.db"
+
+    # Database connections per worker (and as many more under load), and
+    # milliseconds to wait for a lock before a query fails
+    db_pool_size: int = get_int_envar("FLUX_DB_POOL_SIZE", 5)
+    db_busy_timeout: int = get_int_envar("FLUX_DB_BUSY_TIMEOUT", 5000)
     flux_user: str = os.environ.get("FLUX_USER") or "fluxuser"
     flux_token: Optional[str] = os.environ.get("FLUX_TOKEN")
     flux_server_mode: Optional[str] = (
@@ -97,11 +102,70 @@ class Settings(BaseSettings):
     if flux_server_mode not in ["single-user", "multi-user"]:
         raise ValueError("FLUX_SERVER_MODE must be single-user or multi-user")
 
+    # A bearer token Prometheus can read /metrics with (when auth is required)
+    metrics_token: Optional[str] = os.environ.get("FLUX_METRICS_TOKEN")
+
     # Expires in 10 hours
     access_token_expires_minutes: int = get_int_envar(
         "FLUX_ACCESS_TOKEN_EXPIRES_MINUTES", 600
     )
 
+    # In multi-user mode, submit with "sudo -u <user> flux python" instead of signing
+    submit_with_sudo: bool = get_bool_envar("FLUX_SUBMIT_WITH_SUDO")
+
+    # Maximum number of jobs in one batch submit
+    submit_batch_size: int = get_int_envar("FLUX_SUBMIT_BATCH_SIZE", 50000)
+
+    # Number of job templates to keep prepared in memory
+    template_cache_size: int = get_int_envar("FLUX_TEMPLATE_CACHE_SIZE", 256)
+
+    # Environment jobs start with: inherit (the server environment), allow, or user
+    job_environment: str = os.environ.get("FLUX_JOB_ENVIRONMENT") or "inherit"
+    job_environment_allow: list = (
+        os.environ.get("FLUX_JOB_ENVIRONMENT_ALLOW")
+        or "PATH,LD_LIBRARY_PATH,PYTHONPATH,HOME,USER,LOGNAME,SHELL,LANG,LC_*,TERM,TMPDIR"
+    ).split(",")
+
+    if job_environment not in ["inherit", "allow", "user"]:
+        raise ValueError("FLUX_JOB_ENVIRONMENT must be inherit, allow, or user")
+
+    # Seconds a verified user name and password are remembered (0 disables)
+    auth_cache_ttl: int = get_int_envar("FLUX_AUTH_CACHE_TTL", 300)
+
+    # Seconds an authenticated user (id, name, active, superuser) is cached
+    user_cache_ttl: int = get_int_envar("FLUX_USER_CACHE_TTL", 60)
+
+    # Number of Flux handles each worker keeps open, and seconds to wait for one
+    flux_handle_pool_size: int = get_int_envar("FLUX_HANDLE_POOL_SIZE", 4)
+    flux_handle_timeout: int = get_int_envar("FLUX_HANDLE_TIMEOUT", 30)
+
+    # Threads (each with a Flux handle) that read job output off the event loop
+    flux_output_workers: int = get_int_envar("FLUX_OUTPUT_WORKERS", 8)
+
+    # Events buffered per output stream client, and seconds between keepalive pings
+    output_stream_queue_size: int = get_int_envar("FLUX_OUTPUT_STREAM_QUEUE_SIZE", 1000)
+    output_stream_keepalive: int = get_int_envar("FLUX_OUTPUT_STREAM_KEEPALIVE", 15)
+
+    # Output events of a followed job kept in memory for clients that join late
+    output_stream_history: int = get_int_envar("FLUX_OUTPUT_STREAM_HISTORY", 10000)
+
+    # Size (in MB) of complete job output to keep indexed in memory
+    output_index_size: int = get_int_envar("FLUX_OUTPUT_INDEX_SIZE", 64)
+
+    # Directory to cache complete job output in (compressed), and its size in MB
+    output_cache_dir: Optional[str] = os.environ.get("FLUX_OUTPUT_CACHE_DIR")
+    output_cache_size: int = get_int_envar("FLUX_OUTPUT_CACHE_SIZE", 1024)
+
+    # Number of jobs to keep in the in-memory job cache (0 disables it)
+    job_cache_size: int = get_int_envar("FLUX_JOB_CACHE_SIZE", 10000)
+
+    # Number of job owners remembered (least recently used are looked up again)
+    owner_index_size: int = get_int_envar("FLUX_OWNER_INDEX_SIZE", 100000)
+
+    # Number of job details (responses) to cache, and seconds an active job is cached
+    job_detail_cache_size: int = get_int_envar("FLUX_JOB_DETAIL_CACHE_SIZE", 10000)
+    job_detail_ttl: int = get_int_envar("FLUX_JOB_DETAIL_TTL", 2)
+
     # Default server option flags
     option_flags: dict = get_option_flags("FLUX_OPTION_FLAGS")
 
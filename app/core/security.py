@@ -1,3 +1,9 @@
+import collections
+import hashlib
+import hmac
+import secrets
+import threading
+import time
 from datetime import datetime, timedelta
 from typing import Any, Union
 
@@ -46,3 +52,86 @@ def get_password_hash(password: str) -> str:
     Note we aren't providing a salt here, so the same password can generate different.
     """
     return pwd_context.hash(password)
+
+
+class CredentialCache:
+    """
+    Remember recently verified credentials, so we don't run bcrypt every time.
+
+    Entries are keyed by an HMAC of the user name and password with a random
+    key that only lives in this process, so neither is stored. An entry holds
+    the password hash it was verified against, and only counts while the user
+    still has that hash (a password change invalidates it) and for ttl seconds.
+    Failed attempts are never cached.
+    """
+
+    def __init__(self, ttl=300, size=1024):
+        self.ttl = ttl
+        self.size = size
+        self.key = secrets.token_bytes(32)
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, user_name, password):
+        message = f"{user_name}\0{password}".encode("utf-8")
+        return hmac.new(self.key, message, hashlib.sha256).digest()
+
+    def verified(self, user_name: str, password: str, hashed_password: str) -> bool:
+        """
+        Determine if a user name and password were verified against this hash.
+        """
+        if self.ttl <= 0:
+            return False
+        key = self.digest(user_name, password)
+        with self.lock:
+            entry = self.entries.get(key)
+            if (
+                entry is None
+                or entry[2] < time.monotonic()
+                or not hmac.compare_digest(entry[1], hashed_password)
+            ):
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, user_name: str, password: str, hashed_password: str):
+        """
+        Remember a user name and password verified against a hash.
+        """
+        if self.ttl <= 0:
+            return
+        key = self.digest(user_name, password)
+        with self.lock:
+            self.entries[key] = (
+                user_name,
+                hashed_password,
+                time.monotonic() + self.ttl,
+            )
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_name: str = None):
+        """
+        Forget verified credentials for a user (or everyone).
+        """
+        with self.lock:
+            if user_name is None:
+                self.entries.clear()
+                return
+            for key in [k for k, v in self.entries.items() if v[0] == user_name]:
+                del self.entries[key]
+
+    def stats(self):
+        return {
+            "ttl": self.ttl,
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+credential_cache = CredentialCache(ttl=settings.auth_cache_ttl)
@@ -1 +1,3 @@
+from .job import job  # noqa
+from .template import template  # noqa
 from .user import user  # noqa
@@ -0,0 +1,39 @@
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.crud.base import ModelBase
+from app.models.job import Job
+from app.schemas.job import JobCreate, JobUpdate
+
+
+class JobModel(ModelBase[Job, JobCreate, JobUpdate]):
+    """
+    Class that wraps the Job model (the history of submit jobs).
+    """
+
+    async def list_history(
+        self,
+        db: AsyncSession,
+        *,
+        owner_id: Optional[int] = None,
+        before: Optional[Tuple[float, int]] = None,
+        limit: int = 100,
+    ) -> List[Job]:
+        """
+        List jobs newest first (by submit time and id), optionally for one owner.
+
+        Before is the (submit time, id) of the last job of the previous page.
+        Both orders are covered by an index, so a page is an index range scan.
+        """
+        query = select(Job)
+        if owner_id is not None:
+            query = query.filter(Job.owner_id == owner_id)
+        if before is not None:
+            query = query.filter(tuple_(Job.t_submit, Job.id) < tuple_(*before))
+        query = query.order_by(Job.t_submit.desc(), Job.id.desc()).limit(limit)
+        return list((await db.execute(query)).scalars().all())
+
+
+job = JobModel(Job)
@@ -0,0 +1,67 @@
+import json
+from typing import List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.crud.base import ModelBase
+from app.models.template import JobTemplate
+from app.schemas.template import JobTemplateCreate
+
+
+class TemplateModel(ModelBase[JobTemplate, JobTemplateCreate, JobTemplateCreate]):
+    """
+    Class that wraps the JobTemplate model.
+    """
+
+    async def get_by_name(
+        self, db: AsyncSession, *, name: str
+    ) -> Optional[JobTemplate]:
+        """
+        Get a template by name from the database.
+        """
+        query = select(JobTemplate).filter(JobTemplate.name == name)
+        return (await db.execute(query)).scalars().first()
+
+    async def get_multi_by_owner(
+        self, db: AsyncSession, *, owner_id: Optional[int]
+    ) -> List[JobTemplate]:
+        """
+        Get the templates registered by one user.
+        """
+        query = select(JobTemplate).filter(JobTemplate.owner_id == owner_id)
+        return list((await db.execute(query)).scalars().all())
+
+    async def create_or_update(
+        self,
+        db: AsyncSession,
+        *,
+        name: str,
+        params: dict,
+        owner_id: Optional[int] = None,
+        any_owner: bool = True
+    ) -> JobTemplate:
+        """
+        Create a template, or replace the parameters (and bump the version) of one.
+
+        This is one upsert, so concurrent requests for a new name don't
+        conflict. Unless any_owner is set (e.g., for a superuser) only a
+        template of owner_id is replaced, and the template returned is
+        unchanged (and owned by someone else) otherwise.
+        """
+        params = json.dumps(params)
+        statement = insert(JobTemplate).values(
+            name=name, params=params, version=1, owner_id=owner_id
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=["name"],
+            set_={"params": params, "version": JobTemplate.version + 1},
+            where=None if any_owner else JobTemplate.owner_id == owner_id,
+        )
+        await db.execute(statement)
+        await db.commit()
+        return await self.get_by_name(db, name=name)
+
+
+template = TemplateModel(JobTemplate)
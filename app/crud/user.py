@@ -1,11 +1,81 @@
+import collections
+import threading
+import time
 from typing import Any, Dict, Optional, Union
 
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
-from app.core.security import get_password_hash, verify_password
+from app.core.config import settings
+from app.core.security import credential_cache, get_password_hash, verify_password
 from app.crud.base import ModelBase
 from app.models.user import User
-from app.schemas.user import UserCreate, UserUpdate
+from app.schemas.user import UserCreate, UserIdentity, UserUpdate
+
+
+class UserCache:
+    """
+    Identities of recently authenticated users (id, name, active, superuser).
+
+    Requests with a token look up the user on every call, so each worker
+    keeps what authentication needs for ttl seconds. Updating or removing
+    a user invalidates it here, and other workers see the change within ttl.
+    """
+
+    def __init__(self, ttl=60, size=1024):
+        self.ttl = ttl
+        self.size = size
+        self.users = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, id: int) -> Optional[UserIdentity]:
+        with self.lock:
+            entry = self.users.get(id)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def add(self, user: User) -> UserIdentity:
+        identity = UserIdentity(
+            id=user.id,
+            user_name=user.user_name,
+            is_active=user.is_active,
+            is_superuser=user.is_superuser,
+        )
+        if self.ttl <= 0:
+            return identity
+        with self.lock:
+            self.users[user.id] = (identity, time.monotonic() + self.ttl)
+            self.users.move_to_end(user.id)
+            while len(self.users) > self.size:
+                self.users.popitem(last=False)
+        return identity
+
+    def invalidate(self, id: int = None):
+        """
+        Forget a user (or everyone).
+        """
+        with self.lock:
+            if id is None:
+                self.users.clear()
+            else:
+                self.users.pop(id, None)
+
+    def stats(self):
+        return {
+            "ttl": self.ttl,
+            "users": len(self.users),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+user_cache = UserCache(ttl=settings.user_cache_ttl)
 
 
 class UserModel(ModelBase[User, UserCreate, UserUpdate]):
@@ -13,29 +83,52 @@ class UserModel(ModelBase[User, UserCreate, UserUpdate]):
     Class that wraps the User model.
     """
 
-    def get_by_username(self, db: Session, *, user_name: str) -> Optional[User]:
+    async def get_identity(
+        self, db: AsyncSession, *, id: int
+    ) -> Optional[UserIdentity]:
+        """
+        Get the identity of a user by id, from the user cache if we can.
+        """
+        identity = user_cache.get(id)
+        if identity is not None:
+            return identity
+        user = await self.get(db, id=id)
+        if not user:
+            return None
+        return user_cache.add(user)
+
+    async def get_by_username(
+        self, db: AsyncSession, *, user_name: str
+    ) -> Optional[User]:
         """
         Get a user by username from the database.
         """
-        return db.query(User).filter(User.user_name == user_name).first()
+        query = select(User).filter(User.user_name == user_name)
+        return (await db.execute(query)).scalars().first()
 
-    def create(self, db: Session, *, obj_in: UserCreate) -> User:
+    async def create(self, db: AsyncSession, *, obj_in: UserCreate) -> User:
         """
         Create a new user object.
         """
+        # Hashing is slow on purpose, so it runs in a thread
+        hashed_password = await run_in_threadpool(get_password_hash, obj_in.password)
         db_obj = User(
             user_name=obj_in.user_name,
-            hashed_password=get_password_hash(obj_in.password),
+            hashed_password=hashed_password,
             is_superuser=obj_in.is_superuser,
             is_active=obj_in.is_active,
         )
         db.add(db_obj)
-        db.commit()
-        db.refresh(db_obj)
+        await db.commit()
+        await db.refresh(db_obj)
         return db_obj
 
-    def update(
-        self, db: Session, *, db_obj: User, obj_in: Union[UserUpdate, Dict[str, Any]]
+    async def update(
+        self,
+        db: AsyncSession,
+        *,
+        db_obj: User,
+        obj_in: Union[UserUpdate, Dict[str, Any]]
     ) -> User:
         """
         Update a user.
@@ -45,22 +138,49 @@ class UserModel(ModelBase[User, UserCreate, UserUpdate]):
         else:
             update_data = obj_in.dict(exclude_unset=True)
         if update_data["password"]:
-            hashed_password = get_password_hash(update_data["password"])
+            hashed_password = await run_in_threadpool(
+                get_password_hash, update_data["password"]
+            )
             del update_data["password"]
             update_data["hashed_password"] = hashed_password
-        return super().update(db, db_obj=db_obj, obj_in=update_data)
 
-    def authenticate(
-        self, db: Session, *, user_name: str, password: str
+        # Forget the user before and after the commit, so a request in between
+        # can't put the old identity (or password) back in the caches
+        user_name = db_obj.user_name
+        credential_cache.invalidate(user_name)
+        user_cache.invalidate(db_obj.id)
+        user = await super().update(db, db_obj=db_obj, obj_in=update_data)
+        credential_cache.invalidate(user_name)
+        credential_cache.invalidate(user.user_name)
+        user_cache.invalidate(user.id)
+        return user
+
+    async def remove(self, db: AsyncSession, *, id: int) -> User:
+        """
+        Remove a user (and forget their verified credentials).
+        """
+        obj = await super().remove(db, id=id)
+        credential_cache.invalidate(obj.user_name)
+        user_cache.invalidate(obj.id)
+        return obj
+
+    async def authenticate(
+        self, db: AsyncSession, *, user_name: str, password: str
     ) -> Optional[User]:
         """
         Determine if a user exists by the user name and checking the password.
+
+        A password verified recently (against the same hash) is not checked
+        with bcrypt again, see credential_cache.
         """
-        user = self.get_by_username(db, user_name=user_name)
+        user = await self.get_by_username(db, user_name=user_name)
         if not user:
             return None
-        if not verify_password(password, user.hashed_password):
+        if credential_cache.verified(user_name, password, user.hashed_password):
+            return user
+        if not await run_in_threadpool(verify_password, password, user.hashed_password):
             return None
+        credential_cache.add(user_name, password, user.hashed_password)
         return user
 
     def is_active(self, user: User) -> bool:
@@ -2,4 +2,5 @@
 # imported by Alembic
 from app.db.base_class import Base  # noqa
 from app.models.job import Job  # noqa
+from app.models.template import JobTemplate  # noqa
 from app.models.user import User  # noqa
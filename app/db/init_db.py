@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import logging
 import os
 import sys
@@ -13,7 +14,7 @@ if root not in sys.path:
     sys.path.insert(0, root)
 
 import app.schemas as schemas  # noqa
-from app.db.session import SessionLocal  # noqa
+from app.db.session import AsyncSessionLocal  # noqa
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("flux-restful")
@@ -45,8 +46,12 @@ def list_users():
     """
     List users in the database.
     """
-    db = SessionLocal()
-    for user in crud_user.get_multi(db):
+
+    async def get_users():
+        async with AsyncSessionLocal() as db:
+            return await crud_user.get_multi(db)
+
+    for user in asyncio.run(get_users()):
         logger.info(user)
 
 
@@ -54,20 +59,25 @@ def add_user(username, password, superuser=False, is_active=True) -> None:
     """
     One off function to add a user to the database
     """
-    username = username.strip()
-    password = password.strip()
-    db = SessionLocal()
-
-    user = crud_user.get_by_username(db, user_name=username)
-    if not user:
-        user_in = schemas.UserCreate(
-            user_name=username,
-            password=password,
-            is_superuser=superuser,
-            is_active=is_active,
+    asyncio.run(
+        add_user_async(
+            username.strip(), password.strip(), superuser=superuser, is_active=is_active
         )
-        user = crud_user.create(db, obj_in=user_in)  # noqa: F841
-        logger.info(f"User {username} has been created.")
+    )
+
+
+async def add_user_async(username, password, superuser=False, is_active=True):
+    async with AsyncSessionLocal() as db:
+        user = await crud_user.get_by_username(db, user_name=username)
+        if not user:
+            user_in = schemas.UserCreate(
+                user_name=username,
+                password=password,
+                is_superuser=superuser,
+                is_active=is_active,
+            )
+            user = await crud_user.create(db, obj_in=user_in)  # noqa: F841
+            logger.info(f"User {username} has been created.")
 
 
 def main() -> None:
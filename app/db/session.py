@@ -1,14 +1,65 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 from app.core.config import settings
 
 SQLALCHEMY_DATABASE_URL = settings.db_file
 
+# The server uses the same database through aiosqlite, so queries don't block the event loop
+SQLALCHEMY_ASYNC_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace(
+    "sqlite://", "sqlite+aiosqlite://", 1
+)
+
+
+def set_sqlite_pragma(connection, record):
+    """
+    Use write-ahead logging, so readers don't wait on a writer (or each other).
+    """
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={settings.db_busy_timeout}")
+    cursor.close()
+
+
 # The connect argument below is needed for sqlite
+# This engine is used to create tables and by the command line (init_db)
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(
+    SQLALCHEMY_ASYNC_DATABASE_URL,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_pool_size,
+)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False
+)
+
+if SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+    event.listen(engine, "connect", set_sqlite_pragma)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragma)
+
 Base = declarative_base()
+
+
+def get_outdated_tables(engine, metadata):
+    """
+    Find tables in the database that lack columns of their model, by name.
+
+    create_all only creates tables that don't exist, so a table from an
+    earlier version is left as it is and needs to be migrated (or removed).
+    """
+    inspector = inspect(engine)
+    outdated = {}
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        columns = {x["name"] for x in inspector.get_columns(table.name)}
+        missing = [x.name for x in table.columns if x.name not in columns]
+        if missing:
+            outdated[table.name] = missing
+    return outdated
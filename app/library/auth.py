@@ -2,11 +2,12 @@ import logging
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import app.routers.depends as deps
 from app.core.config import settings
 from app.crud import user as crud_user
+from app.crud.user import user_cache
 
 logger = logging.getLogger(__name__)
 
@@ -41,14 +42,17 @@ def alert_auth():
     )
 
 
-def check_auth(
+async def check_auth(
     credentials: HTTPBasicCredentials = Depends(security),
-    db: Session = Depends(deps.get_db),
+    db: AsyncSession = Depends(deps.get_db),
 ):
     """
     Check base64 encoded auth (this is HTTP Basic auth.)
+
+    Returns the identity of the user, so the web interface knows who is a
+    superuser the same way the API does.
     """
-    user = crud_user.authenticate(
+    user = await crud_user.authenticate(
         db, user_name=credentials.username, password=credentials.password
     )
     if not user:
@@ -59,7 +63,7 @@ def check_auth(
         )
     elif not crud_user.is_active(user):
         raise HTTPException(status_code=400, detail="Inactive user")
-    return credentials.username
+    return user_cache.add(user)
 
 
 async def get_basic_header(authentication):
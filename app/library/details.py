@@ -0,0 +1,104 @@
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from app.core.config import settings
+from app.library.jobcache import job_cache
+
+
+def get_etag(info):
+    """
+    An entity tag for a job detail response (a hash of its json)
+    """
+    data = json.dumps(info, sort_keys=True, default=str).encode("utf-8")
+    return '"%s"' % hashlib.sha1(data).hexdigest()
+
+
+def etag_matches(header, etag):
+    """
+    Determine if an If-None-Match header matches an entity tag.
+    """
+    if not header or not etag:
+        return False
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or tag == etag:
+            return True
+    return False
+
+
+class JobDetailCache:
+    """
+    A bounded (least recently used) cache of formatted job details, by job id.
+
+    An inactive job will never change, so it is kept until it is pushed out,
+    and an active job is kept for ttl seconds. Each entry has an entity tag,
+    so a client polling a job can be told it has not changed (304) without
+    asking the broker. The job cache tells us when a job is cleaned up (its
+    final details) or purged, and we forget it then.
+    """
+
+    def __init__(self, size=10000, ttl=2):
+        self.size = size
+        self.ttl = ttl
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, jobid):
+        """
+        Get the (details, etag) of a job, or None if we don't have it.
+        """
+        jobid = int(jobid)
+        with self.lock:
+            entry = self.jobs.get(jobid)
+            if entry is None or (entry[2] is not None and entry[2] < time.monotonic()):
+                self.misses += 1
+                return None
+            self.jobs.move_to_end(jobid)
+            self.hits += 1
+            return dict(entry[0]), entry[1]
+
+    def add(self, jobid, info, terminal=False):
+        """
+        Add the details of a job, returning their etag.
+        """
+        etag = get_etag(info)
+        if self.size <= 0 or (not terminal and self.ttl <= 0):
+            return etag
+        expires = None if terminal else time.monotonic() + self.ttl
+        with self.lock:
+            self.jobs[int(jobid)] = (dict(info), etag, expires)
+            self.jobs.move_to_end(int(jobid))
+            while len(self.jobs) > self.size:
+                self.jobs.popitem(last=False)
+        return etag
+
+    def invalidate(self, jobid):
+        with self.lock:
+            self.jobs.pop(int(jobid), None)
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "ttl": self.ttl,
+            "jobs": len(self.jobs),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+job_details = JobDetailCache(
+    size=settings.job_detail_cache_size, ttl=settings.job_detail_ttl
+)
+
+# An active job that becomes inactive (or is purged) changes for the last time
+job_cache.add_listener(lambda record: job_details.invalidate(record["id"]), "clean")
+job_cache.add_listener(
+    lambda record: job_details.invalidate(record["id"]), "invalidate"
+)
@@ -1,3 +1,8 @@
+import fnmatch
+import os
+
+from app.core.config import settings
+
 # Faux user environment (filtered set of application environment)
 # We could likely find a way to better do this, but likely the users won't have customized environments
 user_env = {
@@ -12,3 +17,30 @@ user_env = {
     "LANG": "C.UTF-8",
     "TERM": "xterm-256color",
 }
+
+
+def get_base_environment(policy="inherit", allow=None, environ=None):
+    """
+    Get the environment jobs start with (before envars in the request).
+
+    inherit: a copy of the server environment (the default)
+    allow: only server environment variables that match the allow list
+    user: the faux user environment above
+    """
+    environ = os.environ if environ is None else environ
+    if policy == "user":
+        return dict(user_env)
+    if policy == "allow":
+        allow = allow or []
+        return {
+            key: value
+            for key, value in environ.items()
+            if any(fnmatch.fnmatchcase(key, pattern) for pattern in allow)
+        }
+    return dict(environ)
+
+
+# Computed once, each job gets a copy
+base_environment = get_base_environment(
+    settings.job_environment, settings.job_environment_allow
+)
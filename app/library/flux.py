@@ -1,19 +1,90 @@
+import asyncio
+import base64
+import functools
 import json
 import os
 import pwd
-import re
 import shlex
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import flux
+import flux.constants
 import flux.job
+from pydantic import ValidationError
 
+import app.library.metrics as metrics
+from app import schemas
 from app.core.config import settings
+from app.library.details import job_details
+from app.library.env import base_environment
+from app.library.handles import HandleTimeout, handles, output_handles
+from app.library.history import job_history
+from app.library.jobcache import constraint_times, job_cache
+from app.library.output import (
+    output_cache,
+    output_index,
+    read_output,
+    snapshot_timeout,
+)
+from app.library.owners import get_jobspec_owner, get_owner, owner_index
+from app.library.resources import resource_cache
+from app.library.search import JobIndex
+from app.library.signer import signer
 
 root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 submit_script = os.path.join(root, "scripts", "submit-job.py")
 
+# Output reads block on event watches, so they run in dedicated threads
+output_executor = ThreadPoolExecutor(
+    max_workers=settings.flux_output_workers, thread_name_prefix="flux-output"
+)
+
+
+# Attributes needed for a detailed listing (a subset of "all")
+job_attrs = [
+    "userid",
+    "urgency",
+    "priority",
+    "t_submit",
+    "t_depend",
+    "t_run",
+    "t_cleanup",
+    "t_inactive",
+    "state",
+    "name",
+    "ntasks",
+    "ncores",
+    "duration",
+    "nnodes",
+    "ranks",
+    "nodelist",
+    "success",
+    "exception_occurred",
+    "exception_type",
+    "exception_severity",
+    "exception_note",
+    "result",
+    "expiration",
+    "waitstatus",
+]
+
+
+# Parameters that can be given for each job of a batch submit
+submit_params = [
+    "command",
+    "num_tasks",
+    "cores_per_task",
+    "gpus_per_task",
+    "num_nodes",
+    "exclusive",
+    "option_flags",
+    "envars",
+    "workdir",
+    "runtime",
+]
+
 
 class FakeJob:
     def __init__(self, jobid):
@@ -43,12 +114,21 @@ def submit_job(handle, fluxjob, user):
     # user_uid = pw_record.pw_uid
     # user_gid = pw_record.pw_gid
 
-    # Update the payload for the correct user
-    fluxjob.environment["HOME"] = pw_record.pw_dir
-    fluxjob.environment["LOGNAME"] = user_name
-    fluxjob.environment["USER"] = pw_record.pw_name
+    # Update the payload for the correct user (the environment of a job from
+    # a template is shared with the template, so it is replaced)
+    fluxjob.environment = dict(
+        fluxjob.environment,
+        HOME=pw_record.pw_dir,
+        LOGNAME=user_name,
+        USER=pw_record.pw_name,
+    )
     payload = json.dumps(fluxjob.jobspec)
 
+    # Sign the job as the user with the signing helper, and submit it ourselves
+    if not settings.submit_with_sudo:
+        signed = signer.sign(pw_record.pw_uid, payload)
+        return flux.job.submit_async(handle, signed, pre_signed=True)
+
     # We ideally need to pipe the payload into flux python
     try:
         ps = subprocess.Popen(("echo", payload), stdout=subprocess.PIPE)
@@ -79,7 +159,7 @@ def clean_submit_args(kwargs):
     # Clean up Nones
     cleaned = {}
     for k, v in kwargs.items():
-        if k == "option_flags" and v is not None:
+        if k == "option_flags" and isinstance(v, str):
             option_flags = {}
             flags = v.split(",")
             for flag in flags:
@@ -95,6 +175,57 @@ def clean_submit_args(kwargs):
     return cleaned
 
 
+def get_capacity():
+    """
+    Get the capacity of the instance from the (cached) live resources.
+
+    If the resources cannot be listed we fall back to what the server was
+    configured with (FLUX_NUMBER_NODES and FLUX_HAS_GPUS).
+    """
+    capacity = resource_cache.capacity()
+    if capacity is None:
+        capacity = {"nodes": settings.flux_nodes, "gpus": 1 if settings.has_gpus else 0}
+    return capacity
+
+
+def validate_capacity(kwargs):
+    """
+    Check the resources a job asks for against the capacity of the instance.
+    """
+    errors = []
+    capacity = get_capacity()
+    num_nodes = kwargs.get("num_nodes")
+    if num_nodes and int(num_nodes) > capacity["nodes"]:
+        errors.append(
+            f"The server only has {capacity['nodes']} nodes, you requested {num_nodes}"
+        )
+
+    # If the user asks for gpus and we don't have any, no go
+    gpus_per_task = kwargs.get("gpus_per_task")
+    if "gpus_per_task" in kwargs and not capacity["gpus"]:
+        errors.append("This server does not support gpus: gpus_per_task cannot be set.")
+        gpus_per_task = None
+
+    # Each task runs on one node, and all tasks need to fit
+    num_tasks = int(kwargs.get("num_tasks") or 1)
+    for name, per_task in [
+        ("cores", kwargs.get("cores_per_task")),
+        ("gpus", gpus_per_task),
+    ]:
+        per_node = capacity.get(f"{name}_per_node")
+        if not per_task or per_node is None:
+            continue
+        if int(per_task) > per_node:
+            errors.append(
+                f"The largest node has {per_node} {name}, you requested {per_task} {name} per task"
+            )
+        elif num_tasks * int(per_task) > capacity[name]:
+            errors.append(
+                f"The server only has {capacity[name]} {name}, you requested {num_tasks * int(per_task)}"
+            )
+    return errors
+
+
 def validate_submit_kwargs(kwargs, envars=None, runtime=None):
     """
     Shared function to validate submit, from API or web UI.
@@ -106,12 +237,8 @@ def validate_submit_kwargs(kwargs, envars=None, runtime=None):
     if "command" not in kwargs or not kwargs["command"]:
         errors.append("'command' is required.")
 
-    # We can't ask for more nodes than available!
-    num_nodes = kwargs.get("num_nodes")
-    if num_nodes and int(num_nodes) > settings.flux_nodes:
-        errors.append(
-            f"The server only has {settings.flux_nodes} nodes, you requested {num_nodes}"
-        )
+    # We can't ask for more resources than the instance has!
+    errors += validate_capacity(kwargs)
 
     # Make sure if option_flags defined, we don't have a -o prefix
     option_flags = kwargs.get("option_flags") or {}
@@ -124,10 +251,6 @@ def validate_submit_kwargs(kwargs, envars=None, runtime=None):
             if "-o" in option:
                 errors.append(f"Please provide keys without -o, {option} is invalid.")
 
-    # If the user asks for gpus and we don't have any, no go
-    if "gpus_per_task" in kwargs and not settings.has_gpus:
-        errors.append("This server does not support gpus: gpus_per_task cannot be set.")
-
     # Minimum value of zero
     if runtime and runtime < 0:
         errors.append(f"Runtime must be >= 0, found {runtime}")
@@ -185,9 +308,9 @@ def prepare_job(user, kwargs, runtime=0, workdir=None, envars=None):
     fluxjob.duration = runtime
 
     # If we are running as the user, we don't want the current (root) environment
-    # However, if we don't provide it, flux stops working.
-    # We need to test different ideas for this.
-    environment = dict(os.environ)
+    # However, if we don't provide it, flux stops working. The base environment
+    # is set by FLUX_JOB_ENVIRONMENT (see app/library/env.py)
+    environment = dict(base_environment)
 
     # Additional envars in the payload?
     environment.update(envars)
@@ -195,38 +318,215 @@ def prepare_job(user, kwargs, runtime=0, workdir=None, envars=None):
     return fluxjob
 
 
-def query_job(jobinfo, query):
+def parse_batch(body):
     """
-    This would be better suited for a database, but should work for small numbers.
+    Parse a batch of job submit parameters, a json array or one object per line.
     """
-    searchstr = "".join([str(x) for x in list(jobinfo.values())])
-    return re.search(query, searchstr)
+    body = body.decode("utf-8") if isinstance(body, bytes) else body
+    if body.lstrip().startswith("["):
+        specs = json.loads(body)
+    else:
+        specs = [json.loads(line) for line in body.splitlines() if line.strip()]
+    return specs
 
 
-def query_jobs(contenders, query):
+def get_submit_kwargs(spec):
     """
-    Wrapper to query more than one job.
+    Split submit parameters into cleaned JobspecV1 kwargs, envars, and runtime.
     """
-    jobs = []
-    for contender in contenders:
-        if not query_job(contender, query):
-            continue
-        jobs.append(contender)
-    return jobs
+    kwargs = {
+        "command": spec.get("command"),
+        "num_tasks": spec.get("num_tasks"),
+        "cores_per_task": spec.get("cores_per_task"),
+        "gpus_per_task": spec.get("gpus_per_task"),
+        "num_nodes": spec.get("num_nodes"),
+        "exclusive": spec.get("exclusive") or False,
+        "option_flags": spec.get("option_flags"),
+    }
+    envars = spec.get("envars") or {}
+    runtime = spec.get("runtime") or 0
+    return clean_submit_args(kwargs), envars, runtime
+
+
+def patch_job(fluxjob, user, params):
+    """
+    Update a prepared job with parameters that do not change its resources.
 
+    This is how a job template is submit with overrides, without building
+    the jobspec (and copying the environment) again. The environment may be
+    shared with the template, so it is replaced rather than changed.
+    """
+    if params.get("command"):
+        command = params["command"]
+        if isinstance(command, str):
+            command = shlex.split(command)
+        fluxjob.jobspec["tasks"][0]["command"] = command
+
+    option_flags = clean_submit_args({"option_flags": params.get("option_flags")})
+    for option, value in option_flags.get("option_flags", {}).items():
+        fluxjob.setattr_shell_option(option, value)
+
+    if params.get("envars"):
+        fluxjob.environment = {**fluxjob.environment, **params["envars"]}
+    if params.get("workdir") is not None:
+        fluxjob.cwd = params["workdir"]
+    if params.get("runtime") is not None:
+        fluxjob.duration = params["runtime"]
+
+    if user and hasattr(user, "user_name"):
+        user = user.user_name
+    fluxjob.setattr("user", user)
+    return fluxjob
 
-def stream_job_output(jobid):
+
+def prepare_batch_job(user, spec):
     """
-    Given a jobid, stream the output
+    Validate and prepare one job of a batch, returning (fluxjob, errors).
     """
-    from app.main import app
+    if not isinstance(spec, dict):
+        return None, ["Each job must be an object with submit parameters."]
+    unknown = set(spec) - set(submit_params)
+    if unknown:
+        return None, [f"Unknown submit parameters {sorted(unknown)}"]
+
+    # Items are raw json, so check (and coerce) their types first
+    try:
+        spec = schemas.JobTemplateSubmit(**spec).dict(exclude_none=True)
+    except ValidationError as e:
+        return None, [
+            "%s: %s" % (".".join(str(x) for x in error["loc"]), error["msg"])
+            for error in e.errors()
+        ]
 
     try:
-        for line in flux.job.event_watch(app.handle, jobid, "guest.output"):
-            if "data" in line.context:
-                yield line.context["data"]
+        kwargs, envars, runtime = get_submit_kwargs(spec)
+        errors = validate_submit_kwargs(kwargs, envars=envars, runtime=runtime)
+        if errors:
+            return None, errors
+        fluxjob = prepare_job(
+            user, kwargs, runtime=runtime, workdir=spec.get("workdir"), envars=envars
+        )
+    except Exception as e:
+        return None, [str(e)]
+    return fluxjob, []
+
+
+def submit(fluxjob, user=None):
+    """
+    Submit one prepared job (on behalf of a user) and record it, returning the id.
+    """
+    try:
+        with handles.handle() as handle, metrics.time_rpc("submit"):
+            jobid = submit_job(handle, fluxjob, user=user).get_id()
     except Exception:
-        pass
+        metrics.submit_errors.inc()
+        raise
+    record_submit(jobid, fluxjob, user)
+    return jobid
+
+
+def record_submit(jobid, fluxjob, user=None):
+    """
+    Record a job we just submit: its owner, and a row in the job history.
+    """
+    metrics.jobs_submitted.inc()
+    owner_index.add(jobid, get_owner(user)[0] or fluxjob_owner(fluxjob))
+    job_history.submit(jobid, fluxjob, user)
+
+
+def fluxjob_owner(fluxjob):
+    """
+    Get the owning user attribute that prepare_job set on a job (if any)
+    """
+    return get_jobspec_owner(getattr(fluxjob, "jobspec", None))
+
+
+def submit_jobs(user, specs, window=1000):
+    """
+    Validate, prepare, and submit a batch of jobs.
+
+    Returns one result per job in the same order, with the id or the errors.
+    Each window of up to window jobs is sent on one handle without waiting
+    for ids, and the handle goes back to the pool before the next window.
+    """
+    results = [None] * len(specs)
+    for start in range(0, len(specs), window):
+        submit_window(user, specs, results, start, min(start + window, len(specs)))
+    return results
+
+
+def submit_window(user, specs, results, start, end):
+    """
+    Submit the jobs from start to end of a batch, filling in their results.
+    """
+    pending = []
+    submitted = []
+    try:
+        with handles.handle() as handle:
+            for index in range(start, end):
+                fluxjob, errors = prepare_batch_job(user, specs[index])
+                if errors:
+                    results[index] = {"Errors": errors}
+                    continue
+                try:
+                    future = submit_job(handle, fluxjob, user=user)
+                    pending.append((index, fluxjob, future))
+                except Exception as e:
+                    metrics.submit_errors.inc()
+                    results[index] = {"Errors": [str(e)]}
+
+            # Every job that was sent gets its id
+            for index, fluxjob, future in pending:
+                try:
+                    with metrics.time_rpc("submit"):
+                        results[index] = {"id": future.get_id()}
+                    submitted.append((results[index]["id"], fluxjob))
+                except Exception as e:
+                    metrics.submit_errors.inc()
+                    results[index] = {"Errors": [str(e)]}
+    except Exception as e:
+        # e.g., no handle, the rest of the window was not submit
+        for index in range(start, end):
+            if results[index] is None:
+                results[index] = {"Errors": [str(e)]}
+
+    # Jobs are recorded once the handle is back in the pool
+    for jobid, fluxjob in submitted:
+        record_submit(jobid, fluxjob, user)
+    return results
+
+
+def query_jobs(contenders, query):
+    """
+    Filter raw job records to those that match a search query.
+
+    Queries are field qualified terms, e.g., "state:run user:alice name:lmp*".
+    The job cache keeps an index up to date, and this builds one on the fly
+    for records that came from the broker.
+    """
+    index = JobIndex()
+    for contender in contenders:
+        index.add(contender, owner=owner_index.owner(contender["id"]))
+    ids = index.search(query)
+    return [x for x in contenders if x["id"] in ids]
+
+
+async def run_output(func, *args, **kwargs):
+    """
+    Run a blocking output read in the output executor, so the event loop
+    can keep serving other requests while it waits on the broker.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        output_executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+async def get_job_output_async(jobid, user=None, delay=None):
+    """
+    Get job output (see get_job_output) without blocking the event loop.
+    """
+    return await run_output(get_job_output, jobid, user=user, delay=delay)
 
 
 def cancel_job(jobid, user):
@@ -235,121 +535,328 @@ def cancel_job(jobid, user):
 
     Returns a message to the user and a return code.
     """
-    # TODO need to validate the user owns the job here
-    from app.main import app
-
+    if not owner_index.can_access(jobid, user):
+        return "Job cannot be cancelled: you do not own job %s." % jobid, 400
     try:
-        flux.job.cancel(app.handle, jobid)
+        with handles.handle() as handle, metrics.time_rpc("cancel"):
+            flux.job.cancel(handle, jobid)
+    except HandleTimeout:
+        raise
     # This is usually FileNotFoundError
     except Exception as e:
         return "Job cannot be cancelled: %s." % e, 400
     return "Job is requested to cancel.", 200
 
 
+def get_complete_output(jobid):
+    """
+    Get the complete output of a job from the output index or cache (or None)
+    """
+    output = output_index.get(jobid)
+    if output is None:
+        output = output_cache.get(jobid)
+        if output is not None:
+            output_index.add(jobid, output)
+    return output
+
+
+def add_output(jobid, output):
+    """
+    Keep output we read from the broker in the index and cache (if it is complete).
+    """
+    output_index.add(jobid, output)
+    output_cache.add(jobid, output)
+
+
 def get_job_output(jobid, user=None, delay=None):
     """
     Given a jobid, get the output.
 
-    If there is a delay, we are requesting on demand, so we want to return early.
+    If there is a delay, we are requesting on demand, so we want to return early:
+    after delay seconds, or as soon as the job is quiet (a snapshot).
     """
-    # TODO need to validate the user owns the job here
-    lines = []
-    start = time.time()
-    from app.main import app
-
+    if not owner_index.can_access(jobid, user):
+        return []
     jobid = flux.job.JobID(jobid)
+    output = get_complete_output(jobid)
+    if output is not None:
+        return output.lines
 
     # If the submit is too close to the log request, it cannot find the file handle
     # It could be also the jobid cannot be found.
-    try:
-        for line in flux.job.event_watch(app.handle, jobid, "guest.output"):
-            if "data" in line.context:
-                lines.append(line.context["data"])
-            now = time.time()
-            if delay is not None and (now - start) > delay:
-                return lines
-    except Exception:
-        pass
-    return lines
+    start = time.time()
+
+    def stop(_):
+        return delay is not None and (time.time() - start) > delay
+
+    # Without a timeout, a quiet job would block until its next output event
+    timeout = snapshot_timeout if delay is not None else None
+    with output_handles.handle() as handle:
+        with metrics.time_rpc("event_watch"):
+            output = read_output(handle, jobid, stop=stop, timeout=timeout)
+    add_output(jobid, output)
+    return output.lines
 
 
-def list_jobs_detailed(user=None, limit=None, query=None):
+def get_job_output_range(jobid, user=None, offset=0, limit=None, tail=None):
     """
-    Get a detailed listing of jobs.
+    Get a range of output lines: from an offset (up to a limit) or the tail.
+
+    Complete output is served from the output index. Otherwise we read the
+    eventlog only as far as needed, or for a tail until we have caught up.
+    Returns the lines with the offset of the first, the next offset to ask
+    for, and if the output is complete.
     """
-    listing = list_jobs(user=user)
-    ids = listing.get()["jobs"]
-    jobs = {}
-    for job in ids:
-        # Stop if a limit is defined and we have hit it!
-        if limit is not None and len(jobs) >= limit:
-            break
+    if not owner_index.can_access(jobid, user):
+        return {"Output": [], "offset": 0, "next_offset": 0, "complete": True}
+    jobid = flux.job.JobID(jobid)
+    output = get_complete_output(jobid)
+    if output is None:
 
-        try:
-            jobinfo = get_job(job["id"], user=user)
+        def stop(output):
+            return tail is None and limit is not None and len(output) >= offset + limit
+
+        with output_handles.handle() as handle:
+            with metrics.time_rpc("event_watch"):
+                output = read_output(handle, jobid, stop=stop, timeout=snapshot_timeout)
+        add_output(jobid, output)
+
+    lines, start, end = output.range(offset=offset, limit=limit, tail=tail)
+    return {
+        "Output": lines,
+        "offset": start,
+        "next_offset": end,
+        "complete": output.complete,
+    }
+
+
+def search_jobs(user=None, query=None, start=0, length=None, order=None):
+    """
+    Search, sort, and page through jobs (for server side data tables).
 
-            # Best effort hack to do a query
-            if query and not query_job(jobinfo, query):
-                continue
+    Order is a list of (attribute, descending) pairs. Sorting and paging are
+    done on the raw job records, so only the requested page is formatted.
+    Returns the page of jobs, the total count, and the count after filtering.
+    """
+    # The job cache has an up to date index, so only matches are copied. A
+    # search can match any job, so once the cache evicted one we go to the broker
+    if job_cache.ready and job_cache.covers():
+        jobids = owner_index.allowed(user)
+        total = job_cache.count(userid=os.getuid(), jobids=jobids)
+        if query:
+            records = job_cache.search(query, userid=os.getuid(), jobids=jobids)
+        else:
+            records = job_cache.list(userid=os.getuid(), jobids=jobids)
+    else:
+        records = list_jobs(user=user, attrs=job_attrs)
+        total = len(records)
+        if query:
+            records = query_jobs(records, query)
+    filtered = len(records)
 
-            # This will trigger a data table warning
-            for needed in ["ranks", "expiration"]:
-                if needed not in jobinfo:
-                    jobinfo[needed] = ""
+    # Sort by the last key first, so the first key takes precedence
+    for attr, descending in reversed(order or []):
+        records.sort(key=lambda x: sort_key(x, attr), reverse=descending)
 
-            jobs[job["id"]] = jobinfo
+    start = start or 0
+    end = None if length is None or length < 0 else start + length
+    jobs = [format_job(record) for record in records[start:end]]
+    return jobs, total, filtered
 
-        except Exception:
-            pass
-    return jobs
 
+def sort_key(job, attr):
+    """
+    Get a sortable value for a job attribute from a raw job record.
 
-def list_jobs(user=None):
+    Values are wrapped so that missing values sort first and numbers and
+    strings can be compared. State and result sort by their lifecycle order.
     """
-    Get a simple listing of jobs (just the ids)
+    if attr in ["runtime", "returncode"]:
+        value = getattr(flux.job.JobInfo(job), attr)
+    elif attr == "exception":
+        value = job.get("exception_occurred") or False
+    else:
+        value = job.get(attr)
+
+    if value is None or value == "":
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, str(value))
+
+
+def list_jobs(
+    user=None,
+    attrs=None,
+    max_entries=0,
+    states=0,
+    since=None,
+    until=None,
+    before=None,
+    ordered=False,
+):
     """
-    # TODO need to validate the user owns the job here
-    from app.main import app
+    Get a simple listing of jobs (just the ids)
 
-    return flux.job.job_list(app.handle)
+    A max_entries of 0 means no limit. States is a bitmask of job states,
+    since is the time a job last changed (submit, depend, run, cleanup, or
+    inactive), and until limits the submit time. Before is a (submit time, id)
+    cursor to list the jobs after. When the job cache is following the journal
+    and has every job the listing could include, we answer from memory, and
+    otherwise go to the broker. Ordered listings are newest submit first.
+    Users that are not superusers only see the jobs they own (by the owner
+    index), so a listing does not look at anyone else's jobs.
+    """
+    jobids = owner_index.allowed(user)
+    if job_cache.ready:
+        jobs = job_cache.list(
+            userid=os.getuid(),
+            limit=max_entries,
+            states=states,
+            since=since,
+            until=until,
+            jobids=jobids,
+            before=before,
+        )
 
+        # A full listing only needs the jobs submit after the last one
+        oldest = None
+        if jobs and max_entries and len(jobs) >= max_entries:
+            oldest = min(x["t_submit"] for x in jobs)
+        if job_cache.covers(oldest=oldest, since=since):
+            return jobs
+
+    # The broker does not know our owners, and job-list orders jobs by state
+    # (not submit), so in either case the limit is applied after
+    limit = max_entries
+    if jobids is not None or ordered or before is not None:
+        max_entries = 0
+
+    # Everything after the cursor was submit at or before it
+    if before is not None and (until is None or before[0] < until):
+        until = before[0]
+
+    # Time bounds are pushed into the job-list query as a constraint
+    constraint = []
+    if since is not None:
+        constraint.append({"or": [{x: [f">={since}"]} for x in constraint_times]})
+    if until is not None:
+        constraint.append({"t_submit": [f"<={until}"]})
+
+    attrs = attrs or ["all"]
+    with handles.handle() as handle:
+        rpc = flux.job.job_list(
+            handle,
+            max_entries=max_entries,
+            attrs=attrs,
+            states=states,
+            constraint={"and": constraint} if constraint else None,
+        )
+        with metrics.time_rpc("job-list.list"):
+            jobs = rpc.get_jobs()
+    if jobids is not None:
+        # Without the job cache we may not know who owns these jobs yet
+        owner_index.lookup([x["id"] for x in jobs])
+        jobids = owner_index.allowed(user)
+        jobs = [x for x in jobs if x["id"] in jobids]
+    if ordered or before is not None:
+        jobs.sort(key=lambda x: (x.get("t_submit", 0), x["id"]), reverse=True)
+    if before is not None:
+        jobs = [x for x in jobs if (x.get("t_submit", 0), x["id"]) < before]
+    return jobs[: limit or None]
+
+
+def list_jobs_page(
+    user=None, limit=None, cursor=None, since=None, until=None, state=None, attrs=None
+):
+    """
+    Get one page of jobs in a stable order, newest submit first.
 
-def get_simple_job(jobid):
+    The cursor is an opaque token from a previous page that points at the
+    last job returned. Returns the page of jobs, and the cursor for the next
+    page (or None if this is the last one).
     """
-    Not used - an original (simpler) implementation.
+    states = parse_states(state)
+    after = decode_cursor(cursor) if cursor else None
+    if limit is not None and limit <= 0:
+        return [], None
+
+    # One more than the limit tells us if there is a next page
+    records = list_jobs(
+        user=user,
+        attrs=attrs,
+        max_entries=limit + 1 if limit is not None else 0,
+        states=states,
+        since=since,
+        until=until,
+        before=after,
+        ordered=True,
+    )
+    if limit is None or len(records) <= limit:
+        return records, None
+    page = records[:limit]
+    return page, encode_cursor(page[-1]) if page else None
+
+
+def parse_states(state):
     """
-    from app.main import app
+    Parse a comma separated list of state names into a job-list states mask.
 
-    info = flux.job.job_list_id(app.handle, jobid, attrs=["all"])
-    return json.loads(info.get_str())["job"]
+    Virtual states (pending, running, active) are allowed too.
+    """
+    states = 0
+    for name in (state or "").split(","):
+        name = name.strip().upper()
+        if not name:
+            continue
+        value = getattr(flux.constants, f"FLUX_JOB_STATE_{name}", None)
+        if value is None:
+            raise ValueError(f"{name} is not a known job state.")
+        states |= value
+    return states
 
 
-def get_job(jobid, user=None):
+def parse_jobid(jobid):
     """
-    Get details for a job
+    Parse a job id (an integer, f58, etc.), or raise ValueError if it is not one.
     """
-    # TODO need to validate the user owns the job here
-    from app.main import app
+    try:
+        return flux.job.JobID(jobid)
+    except Exception:
+        raise ValueError(f"{jobid} is not a valid job id.")
 
-    jobid = flux.job.JobID(jobid)
 
-    payload = {"id": jobid, "attrs": ["all"]}
-    rpc = flux.job.list.JobListIdRPC(app.handle, "job-list.list-id", payload)
+def encode_cursor(job):
+    """
+    Encode an opaque cursor that points at a job (by submit time and id)
+    """
+    token = json.dumps([job.get("t_submit", 0), job["id"]])
+    return base64.urlsafe_b64encode(token.encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor from encode_cursor back into a (submit time, id) tuple.
+    """
     try:
-        jobinfo = rpc.get()
+        t_submit, jobid = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))
+        return (float(t_submit), int(jobid))
+    except Exception:
+        raise ValueError(f"{cursor} is not a valid cursor.")
 
-    # The job does not exist!
-    except FileNotFoundError:
-        return None
 
-    jobinfo = jobinfo["job"]
+def format_job(job):
+    """
+    Add user friendly fields to a job record from job-list.
 
-    # User friendly string from integer
-    state = jobinfo["state"]
-    jobinfo["state"] = flux.job.info.statetostr(state)
+    These are the same fields JobInfo computes, and we derive them here
+    instead of asking the broker for each job.
+    """
+    info = flux.job.JobInfo(job)
+    jobinfo = dict(job)
 
-    # Get job info to add to result
-    info = rpc.get_jobinfo()
+    # User friendly string from integer
+    jobinfo["state"] = flux.job.info.statetostr(job["state"])
     jobinfo["nnodes"] = info._nnodes
     jobinfo["result"] = info.result
     jobinfo["returncode"] = info.returncode
@@ -357,10 +864,69 @@ def get_job(jobid, user=None):
     jobinfo["priority"] = info._priority
     jobinfo["waitstatus"] = info._waitstatus
     jobinfo["nodelist"] = info._nodelist
-    jobinfo["nodelist"] = info._nodelist
     jobinfo["exception"] = info._exception.__dict__
 
-    # Only appears after finished?
-    if "duration" not in jobinfo:
-        jobinfo["duration"] = ""
+    # Only appears after finished? These otherwise trigger a data table warning
+    for needed in ["duration", "ranks", "expiration"]:
+        if needed not in jobinfo:
+            jobinfo[needed] = ""
     return jobinfo
+
+
+def get_simple_job(jobid):
+    """
+    Not used - an original (simpler) implementation.
+    """
+    with handles.handle() as handle:
+        info = flux.job.job_list_id(handle, jobid, attrs=["all"])
+        return json.loads(info.get_str())["job"]
+
+
+def get_job(jobid, user=None):
+    """
+    Get details for a job (None if it does not exist, or the user can't see it)
+    """
+    return get_job_detail(jobid, user=user)[0]
+
+
+def get_job_detail(jobid, user=None):
+    """
+    Get the details of a job and their etag, (None, None) if there are none.
+
+    Details are served from the job detail cache, then the job cache, and
+    we only ask the broker on a miss of both.
+    """
+    if not owner_index.can_access(jobid, user):
+        return None, None
+    jobid = flux.job.JobID(jobid)
+    entry = job_details.get(jobid)
+    if entry is not None:
+        return entry
+
+    # Serve from the job cache, and fall back to the broker on a miss
+    record = job_cache.get(jobid)
+    if record is None:
+        record = get_job_record(jobid)
+    if record is None:
+        return None, None
+    info = format_job(record)
+    terminal = record["state"] == flux.constants.FLUX_JOB_STATE_INACTIVE
+    return info, job_details.add(jobid, info, terminal=terminal)
+
+
+def get_job_record(jobid):
+    """
+    Ask the broker for the raw job-list record of a job (None if it does not exist)
+    """
+    payload = {"id": jobid, "attrs": ["all"]}
+    with handles.handle() as handle:
+        rpc = flux.job.list.JobListIdRPC(handle, "job-list.list-id", payload)
+        try:
+            with metrics.time_rpc("job-list.list-id"):
+                jobinfo = rpc.get()
+
+        # The job does not exist!
+        except FileNotFoundError:
+            return None
+
+        return jobinfo["job"]
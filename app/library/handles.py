@@ -0,0 +1,232 @@
+import errno
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import flux
+
+from app.core.config import settings
+
+# Errors that indicate the connection to the broker is gone (and not the RPC)
+connection_errors = {
+    errno.ECONNRESET,
+    errno.ECONNREFUSED,
+    errno.ENOTCONN,
+    errno.EPIPE,
+    errno.EHOSTUNREACH,
+}
+
+
+class HandleTimeout(TimeoutError):
+    """
+    No handle became available in time (the server is too busy, a 503)
+    """
+
+
+class HandlePool:
+    """
+    A bounded pool of Flux handles shared by the requests of one worker.
+
+    Handles are opened once (at startup) and then lent out per request,
+    so request latency does not include a broker connect. A Flux handle
+    is not safe to share between concurrent users, so each caller gets
+    its own for the duration of the `handle()` context. Waiting for a
+    handle blocks, so this is only used from a thread (e.g., with
+    run_in_threadpool) and never on the event loop.
+    """
+
+    def __init__(self, size=4, timeout=30, check_after=30):
+        self.size = max(size, 1)
+        self.timeout = timeout
+        self.check_after = check_after
+        self._available = queue.LifoQueue(maxsize=self.size)
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._instance = None
+
+        # Statistics exposed via stats()
+        self.acquired = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.reconnects = 0
+        self.discarded = 0
+
+    def connect(self):
+        """
+        Open a new connection to the broker.
+        """
+        return flux.Flux()
+
+    def open(self):
+        """
+        Open all handles up front (called on application startup).
+        """
+        while True:
+            with self._lock:
+                if self._opened >= self.size:
+                    return
+                self._opened += 1
+            try:
+                self._available.put((self.connect(), time.time()))
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+
+    def close(self):
+        """
+        Drop all idle handles (called on application shutdown).
+        """
+        while True:
+            try:
+                self._available.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._opened -= 1
+
+    def is_healthy(self, handle):
+        """
+        Ping the broker to ensure a handle that was idle is still usable.
+        """
+        try:
+            handle.rpc("broker.ping", {"seq": 0, "pad": ""}).get()
+        except OSError as e:
+            if e.errno in connection_errors:
+                return False
+        except Exception:
+            return False
+        return True
+
+    def acquire(self):
+        """
+        Get a handle from the pool, opening one if we are under the size.
+        """
+        try:
+            handle, last_used = self._available.get_nowait()
+        except queue.Empty:
+            handle = None
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    handle = self.connect()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+                last_used = time.time()
+
+        # All handles are in use, wait for one to be returned
+        if handle is None:
+            start = time.time()
+            try:
+                handle, last_used = self._available.get(timeout=self.timeout)
+            except queue.Empty:
+                raise HandleTimeout(
+                    f"No Flux handle became available within {self.timeout} seconds."
+                )
+            waited = time.time() - start
+            with self._lock:
+                self.waits += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+        # A handle that sat idle for a while gets a health check first
+        if time.time() - last_used > self.check_after and not self.is_healthy(handle):
+            try:
+                handle = self.reconnect()
+            except Exception:
+                self.discard(handle)
+                raise
+
+        with self._lock:
+            self.acquired += 1
+        return handle
+
+    def release(self, handle):
+        """
+        Return a handle to the pool.
+        """
+        self._available.put((handle, time.time()))
+
+    def discard(self, handle):
+        """
+        Forget a broken handle, a new one is opened on the next acquire.
+        """
+        with self._lock:
+            self._opened -= 1
+            self.discarded += 1
+
+    def reconnect(self):
+        """
+        Replace a broken handle with a new connection.
+        """
+        with self._lock:
+            self.reconnects += 1
+        return self.connect()
+
+    def instance(self, handle=None):
+        """
+        Identify the instance we are connected to (by its broker start time).
+
+        Job ids start over in a new instance, so this keys what we keep about
+        jobs across restarts. It is asked for with the handle given (or one
+        from the pool), and only remembered once we know it.
+        """
+        if self._instance is None:
+            if handle is not None:
+                self._instance = str(handle.attr_get("broker.starttime"))
+            else:
+                with self.handle() as handle:
+                    self._instance = str(handle.attr_get("broker.starttime"))
+        return self._instance
+
+    @contextmanager
+    def handle(self):
+        """
+        Borrow a handle for the duration of the context.
+        """
+        handle = self.acquire()
+        try:
+            yield handle
+        except OSError as e:
+            if e.errno in connection_errors:
+                self.discard(handle)
+                handle = None
+            raise
+        finally:
+            if handle is not None:
+                self.release(handle)
+
+    def stats(self):
+        """
+        Summary of pool size, usage, and time spent waiting for a handle.
+        """
+        available = self._available.qsize()
+        return {
+            "size": self.size,
+            "open": self._opened,
+            "available": available,
+            "in_use": self._opened - available,
+            "acquired": self.acquired,
+            "waits": self.waits,
+            "wait_seconds": round(self.wait_seconds, 6),
+            "max_wait_seconds": round(self.max_wait_seconds, 6),
+            "reconnects": self.reconnects,
+            "discarded": self.discarded,
+        }
+
+
+handles = HandlePool(
+    size=settings.flux_handle_pool_size, timeout=settings.flux_handle_timeout
+)
+
+# Output watches block until the next event, so they get their own handles
+output_handles = HandlePool(
+    size=settings.flux_output_workers, timeout=settings.flux_handle_timeout
+)
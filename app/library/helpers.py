@@ -24,6 +24,23 @@ def get_int_arg(payload, key):
     return arg
 
 
+def get_datatables_order(params):
+    """
+    Parse jquery data tables order[i][column] and columns[j][data] parameters.
+
+    Returns a list of (column data name, descending) in order of precedence.
+    """
+    order = []
+    i = 0
+    while f"order[{i}][column]" in params:
+        column = params.get(f"order[{i}][column]")
+        name = params.get(f"columns[{column}][data]")
+        if name:
+            order.append((name, params.get(f"order[{i}][dir]") == "desc"))
+        i += 1
+    return order
+
+
 def read_json(filename):
     with open(filename, "r") as fd:
         content = json.loads(fd.read())
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import logging
+import queue
+import threading
+import time
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert
+
+from app.db.session import SessionLocal
+from app.library.handles import handles
+from app.library.jobcache import get_jobspec_name, job_cache
+from app.library.owners import owner_index
+from app.models.job import Job
+from app.models.user import User
+
+logger = logging.getLogger(__name__)
+
+# Columns a later (terminal) record should not overwrite with nothing
+submit_columns = ["name", "owner_id", "user_name", "userid", "jobspec_hash", "t_submit"]
+
+
+def get_jobspec_hash(jobspec):
+    """
+    A sha256 of a jobspec (as canonical json)
+    """
+    data = json.dumps(jobspec, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+class JobHistory:
+    """
+    Record submit jobs and their terminal state in the database.
+
+    Requests only add a row to a queue, and one background thread writes
+    them in batches (one transaction each), so a submit never waits on the
+    database (or the broker) and SQLite sees a single writer. Rows are upserts
+    by job id and instance (job ids start over in a new instance), so the
+    submit and the end of a job can arrive in either order. Rows wait in the
+    writer until we know the instance. The journal replays every job when we
+    start, and only jobs that ended after the last one we recorded are
+    written again.
+    """
+
+    def __init__(self, batch_size=500, interval=0.5):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.recorded = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+        # The instance, and the end of the last job it recorded (see load)
+        self.instance = None
+        self.last_inactive = 0.0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start the writer thread (if it is not running yet)
+        """
+        with self.lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self.run, name="flux-job-history", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the thread, writing what is left in the queue first.
+        """
+        self._stopped.set()
+        with self.lock:
+            if self._thread is not None:
+                self._thread.join(timeout=5)
+                self._thread = None
+
+    def load(self):
+        """
+        Identify the instance (by its start time) and the last job it recorded.
+
+        This is called by the writer thread, and returns False (to try again
+        with the next batch) if we cannot yet.
+        """
+        if self.instance is not None:
+            return True
+        try:
+            instance = handles.instance()
+            with SessionLocal() as db:
+                last = db.execute(
+                    select(func.max(Job.t_inactive)).where(Job.instance == instance)
+                ).scalar()
+        except Exception as e:
+            logger.warning(f"Cannot identify the instance for job history: {e}")
+            return False
+        self.last_inactive = last or 0.0
+        self.instance = instance
+        return True
+
+    def record(self, row):
+        self.start()
+        self.queue.put(row)
+
+    def submit(self, jobid, fluxjob, user=None):
+        """
+        Record a job that was just submit (on behalf of a user).
+        """
+        jobspec = getattr(fluxjob, "jobspec", None) or {}
+        row = {
+            "id": int(jobid),
+            "name": get_jobspec_name(jobspec),
+            "jobspec_hash": get_jobspec_hash(jobspec),
+            "t_submit": time.time(),
+        }
+        if user and hasattr(user, "user_name"):
+            row["owner_id"] = user.id
+            row["user_name"] = user.user_name
+        elif user:
+            row["user_name"] = str(user)
+        self.record(row)
+
+    def finish(self, record):
+        """
+        Record the terminal state of a job (a job cache record).
+        """
+        row = {
+            "id": int(record["id"]),
+            "name": record.get("name") or None,
+            "userid": record.get("userid"),
+            "t_submit": record.get("t_submit"),
+            "state": record.get("state"),
+            "t_inactive": record.get("t_inactive"),
+        }
+        owner = owner_index.owner(record["id"])
+        if owner:
+            row["user_name"] = owner
+        for key in ["result", "success", "waitstatus"]:
+            if record.get(key) != "":
+                row[key] = record.get(key)
+        self.record(row)
+
+    def run(self):
+        rows = []
+        while not (self._stopped.is_set() and self.queue.empty()):
+            try:
+                rows.append(self.queue.get(timeout=self.interval))
+                while len(rows) < self.batch_size:
+                    rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if not rows:
+                continue
+            if not self.load():
+                self._stopped.wait(1.0)
+                continue
+            self.write(rows)
+            rows = []
+        if rows:
+            logger.warning(f"Cannot record {len(rows)} jobs in history: no instance")
+
+    def prepare(self, rows):
+        """
+        Set the instance of rows, and skip the jobs the journal replayed.
+        """
+        prepared = []
+        for row in rows:
+            if row.get("t_inactive") and row["t_inactive"] <= self.last_inactive:
+                continue
+            prepared.append(dict(row, instance=self.instance))
+        return prepared
+
+    def write(self, rows):
+        """
+        Upsert a batch of rows in one transaction.
+        """
+        rows = self.prepare(rows)
+        if not rows:
+            return
+        try:
+            with SessionLocal() as db:
+                self.set_owners(db, rows)
+                for row in rows:
+                    statement = insert(Job).values(**row)
+
+                    # Keep what we know from the submit if the update lacks it
+                    update = {
+                        key: value
+                        for key, value in row.items()
+                        if key not in ["id", "instance"]
+                        and not (key in submit_columns and value is None)
+                    }
+                    db.execute(
+                        statement.on_conflict_do_update(
+                            index_elements=["instance", "id"], set_=update
+                        )
+                    )
+                db.commit()
+            self.recorded += len(rows)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Cannot record {len(rows)} jobs in history: {e}")
+
+    def set_owners(self, db, rows):
+        """
+        Find the owning user of rows that only have a user name.
+
+        Jobs from the journal (and the web interface) know the name of the
+        user that submit them, and the history of a user is by owner id.
+        """
+        names = {
+            row["user_name"]
+            for row in rows
+            if row.get("user_name") and not row.get("owner_id")
+        }
+        if not names:
+            return
+        query = select(User.user_name, User.id).where(User.user_name.in_(names))
+        owners = dict(db.execute(query).all())
+        for row in rows:
+            if row.get("user_name") in owners and not row.get("owner_id"):
+                row["owner_id"] = owners[row["user_name"]]
+
+    def stats(self):
+        return {
+            "recorded": self.recorded,
+            "pending": self.queue.qsize(),
+            "errors": self.errors,
+        }
+
+
+job_history = JobHistory()
+
+# Terminal states come from the job cache, which follows the journal
+job_cache.add_listener(job_history.finish)
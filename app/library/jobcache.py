@@ -0,0 +1,507 @@
+import collections
+import logging
+import os
+import threading
+
+import flux
+import flux.constants
+import flux.job
+from flux.hostlist import Hostlist
+from flux.idset import IDset
+
+from app.core.config import settings
+from app.library.search import JobIndex
+
+logger = logging.getLogger(__name__)
+
+# Job result for a fatal exception, anything else is a failure
+exception_results = {
+    "cancel": flux.constants.FLUX_JOB_RESULT_CANCELED,
+    "timeout": flux.constants.FLUX_JOB_RESULT_TIMEOUT,
+}
+
+# Timestamps of state changes in a job record
+change_times = [
+    "t_submit",
+    "t_depend",
+    "t_priority",
+    "t_sched",
+    "t_run",
+    "t_cleanup",
+    "t_inactive",
+]
+
+# The timestamps job-list can filter on (in a constraint)
+constraint_times = ["t_submit", "t_depend", "t_run", "t_cleanup", "t_inactive"]
+
+
+def get_jobspec_name(jobspec):
+    """
+    Derive the job name from a jobspec the same way job-list does.
+    """
+    system = jobspec.get("attributes", {}).get("system", {})
+    name = system.get("job", {}).get("name")
+    if name:
+        return name
+    try:
+        return os.path.basename(jobspec["tasks"][0]["command"][0])
+    except (KeyError, IndexError, TypeError):
+        return ""
+
+
+def get_jobspec_ntasks(jobspec):
+    """
+    Derive the number of tasks from a jobspec (total, or per slot x slots)
+    """
+    try:
+        count = jobspec["tasks"][0]["count"]
+    except (KeyError, IndexError, TypeError):
+        return ""
+    if "total" in count:
+        return count["total"]
+
+    # Multiply counts of resources down to the task slot
+    slots = 1
+    resources = jobspec.get("resources", [])
+    while resources:
+        resource = resources[0]
+        slots *= resource.get("count", 1)
+        if resource.get("type") == "slot":
+            break
+        resources = resource.get("with", [])
+    return count.get("per_slot", 1) * slots
+
+
+def get_jobspec_count(jobspec, kind):
+    """
+    Count the resources of one type (e.g., gpu) a jobspec asks for in total.
+    """
+
+    def count(resources, multiplier):
+        total = 0
+        for resource in resources:
+            number = resource.get("count", 1)
+            if isinstance(number, dict):
+                number = number.get("min", 1)
+            number *= multiplier
+            if resource.get("type") == kind:
+                total += number
+            else:
+                total += count(resource.get("with", []), number)
+        return total
+
+    try:
+        return count(jobspec.get("resources", []), 1)
+    except (AttributeError, TypeError):
+        return 0
+
+
+def get_changed_time(record):
+    """
+    The last time a job record changed state (submit, depend, run, cleanup, inactive)
+    """
+    return max(record.get(x) or 0 for x in change_times)
+
+
+class JobCache:
+    """
+    An in-memory table of job records kept current from the job-manager journal.
+
+    A background thread subscribes to the events journal and applies each
+    event to a job-list style record (the attributes of job-list "all"), so
+    listings and lookups can be served without a round trip to the broker.
+    Only the newest `size` jobs (by submit) are kept, and a lookup for
+    anything else falls back to the broker. We remember how far back the
+    jobs we dropped go (see covers), so a listing that reaches past them
+    can fall back too. The owner of each job (the user attribute of its
+    jobspec) is kept beside the records, and is not part of them.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.jobs = collections.OrderedDict()
+        self.owners = {}
+        self.index = JobIndex()
+        self.lock = threading.RLock()
+
+        # Ready when the journal history has been replayed
+        self.ready = False
+        self.since = 0.0
+        self.hits = 0
+        self.misses = 0
+
+        # The newest submit, and latest change (inf if it could still change),
+        # of a job we evicted
+        self.horizon = None
+        self.changed = None
+
+        # Functions called with a copy of a record by event name, e.g., submit,
+        # clean (inactive), and invalidate (purged)
+        self.listeners = {"submit": [], "clean": [], "invalidate": []}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.size > 0 and hasattr(flux.job, "JournalConsumer")
+
+    def start(self):
+        """
+        Start following the journal in a background thread.
+        """
+        if not self.enabled:
+            logger.info("Job cache is disabled.")
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self.run, name="flux-job-cache", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop following the journal (the thread exits on the next poll).
+        """
+        self._stopped.set()
+        self.ready = False
+
+    def run(self):
+        """
+        Consume journal events, reconnecting (from the last event) on error.
+        """
+        while not self._stopped.is_set():
+            try:
+                consumer = flux.job.JournalConsumer(
+                    flux.Flux(), since=self.since, include_sentinel=True
+                ).start()
+                while not self._stopped.is_set():
+                    try:
+                        event = consumer.poll(timeout=1.0)
+                    except TimeoutError:
+                        continue
+                    if event is None:
+                        break
+                    self.apply(event)
+            except Exception as e:
+                logger.warning(f"Job cache lost the journal, reconnecting: {e}")
+            self.ready = False
+            self._stopped.wait(1.0)
+
+    def apply(self, event):
+        """
+        Update the job record for one journal event.
+        """
+        # The sentinel marks the end of historical events
+        if event.is_empty():
+            self.ready = True
+            return
+
+        self.since = max(self.since, event.timestamp)
+        jobid = int(event.jobid)
+        with self.lock:
+            if event.name == "submit":
+                record = self.add(jobid, event)
+            elif jobid in self.jobs:
+                record = self.jobs[jobid]
+                self.update(record, event)
+                if event.name == "invalidate":
+                    self.remove(jobid)
+                else:
+                    self.index.add(record, owner=self.owners.get(jobid))
+
+            # We don't keep the job, but listeners still hear where it runs
+            elif event.name in ["alloc", "free"]:
+                record = {"id": jobid}
+                self.update(record, event)
+            else:
+                return
+
+        for listener in self.listeners.get(event.name, []):
+            listener(dict(record))
+
+    def add_listener(self, listener, event="clean"):
+        """
+        Call a function with (a copy of) each job record on an event.
+        """
+        listeners = self.listeners.setdefault(event, [])
+        if listener not in listeners:
+            listeners.append(listener)
+
+    def add(self, jobid, event):
+        """
+        Add (and return) a new job record on submit, evicting the oldest if full.
+        """
+        jobspec = event.jobspec or {}
+        system = jobspec.get("attributes", {}).get("system", {})
+        record = {
+            "id": jobid,
+            "userid": event.context.get("userid"),
+            "urgency": event.context.get("urgency"),
+            "priority": "",
+            "state": flux.constants.FLUX_JOB_STATE_DEPEND,
+            "name": get_jobspec_name(jobspec),
+            "cwd": system.get("cwd", ""),
+            "ntasks": get_jobspec_ntasks(jobspec),
+            "ngpus": get_jobspec_count(jobspec, "gpu"),
+            "duration": system.get("duration", 0.0),
+            "t_submit": event.timestamp,
+            "success": "",
+            "exception_occurred": False,
+            "result": "",
+            "dependencies": [],
+        }
+        if system.get("queue"):
+            record["queue"] = system["queue"]
+        self.jobs[jobid] = record
+        if system.get("user"):
+            self.owners[jobid] = system["user"]
+        self.index.add(record, owner=self.owners.get(jobid))
+        while len(self.jobs) > self.size:
+            self.evict()
+        return record
+
+    def owner(self, jobid):
+        """
+        Get the owner (user attribute) of a job we keep, or None.
+        """
+        return self.owners.get(int(jobid))
+
+    def remove(self, jobid):
+        record = self.jobs.pop(jobid)
+        self.owners.pop(jobid, None)
+        self.index.remove(jobid)
+        return record
+
+    def evict(self):
+        """
+        Remove the oldest job (by submit), so the jobs we keep have no gaps.
+        """
+        jobid = next(iter(self.jobs))
+        record = self.remove(jobid)
+
+        # An active job can still change, and we won't hear about it
+        changed = get_changed_time(record)
+        if record["state"] != flux.constants.FLUX_JOB_STATE_INACTIVE:
+            changed = float("inf")
+        self.horizon = max(self.horizon or 0, record["t_submit"])
+        self.changed = max(self.changed or 0, changed)
+
+    def covers(self, oldest=None, since=None):
+        """
+        Determine if the cache has every job a listing could include.
+
+        That is every job submit after oldest (e.g., the last of a full page),
+        or every job that changed since a time. Until we evict a job we have
+        all of them.
+        """
+        if self.horizon is None:
+            return True
+        if oldest is not None and oldest > self.horizon:
+            return True
+        return since is not None and since > self.changed
+
+    def update(self, record, event):
+        """
+        Apply a (non-submit) event to a record, following RFC 21 states.
+        """
+        context = event.context
+        if event.name == "validate":
+            record["t_depend"] = event.timestamp
+
+        elif event.name == "depend":
+            record["state"] = flux.constants.FLUX_JOB_STATE_PRIORITY
+            record["t_priority"] = event.timestamp
+
+        elif event.name == "priority":
+            record["priority"] = context.get("priority", "")
+            if record["state"] == flux.constants.FLUX_JOB_STATE_PRIORITY:
+                record["state"] = flux.constants.FLUX_JOB_STATE_SCHED
+                record["t_sched"] = event.timestamp
+
+        elif event.name == "dependency-add":
+            description = context.get("description")
+            # Copies of records share the list, so it is replaced (not changed)
+            if description and description not in record["dependencies"]:
+                record["dependencies"] = record["dependencies"] + [description]
+
+        elif event.name == "dependency-remove":
+            description = context.get("description")
+            record["dependencies"] = [
+                x for x in record["dependencies"] if x != description
+            ]
+
+        elif event.name == "annotations":
+            if context.get("annotations"):
+                record["annotations"] = context["annotations"]
+            else:
+                record.pop("annotations", None)
+
+        elif event.name == "urgency":
+            record["urgency"] = context.get("urgency")
+
+        elif event.name == "alloc":
+            record["state"] = flux.constants.FLUX_JOB_STATE_RUN
+            record["t_run"] = event.timestamp
+            execution = (event.R or {}).get("execution", {})
+            nodelist = Hostlist(execution.get("nodelist", []))
+            record["nodelist"] = nodelist.encode()
+            record["nnodes"] = len(nodelist)
+            ranks = [item.get("rank", "") for item in execution.get("R_lite", [])]
+            record["ranks"] = ",".join(ranks)
+            record["ncores"] = sum(
+                len(IDset(item.get("rank", ""))) * len(IDset(item["children"]["core"]))
+                for item in execution.get("R_lite", [])
+                if "core" in item.get("children", {})
+            )
+            if execution.get("expiration"):
+                record["expiration"] = execution["expiration"]
+
+        elif event.name == "finish":
+            status = context.get("status", 0)
+            record["waitstatus"] = status
+            record["success"] = status == 0 and not record["exception_occurred"]
+            if record["result"] == "":
+                record["result"] = (
+                    flux.constants.FLUX_JOB_RESULT_COMPLETED
+                    if status == 0
+                    else flux.constants.FLUX_JOB_RESULT_FAILED
+                )
+            self.cleanup(record, event)
+
+        elif event.name == "exception":
+            severity = context.get("severity", 0)
+            if not record["exception_occurred"] or severity == 0:
+                record["exception_occurred"] = True
+                record["exception_type"] = context.get("type", "")
+                record["exception_severity"] = severity
+                record["exception_note"] = context.get("note", "")
+
+            # Severity 0 exceptions are fatal to the job
+            if severity == 0:
+                record["success"] = False
+                if record["result"] == "":
+                    record["result"] = exception_results.get(
+                        context.get("type"), flux.constants.FLUX_JOB_RESULT_FAILED
+                    )
+                self.cleanup(record, event)
+
+        elif event.name == "clean":
+            record["state"] = flux.constants.FLUX_JOB_STATE_INACTIVE
+            record["t_inactive"] = event.timestamp
+
+    def cleanup(self, record, event):
+        """
+        Move a job that finished (or failed) into cleanup.
+        """
+        if record["state"] < flux.constants.FLUX_JOB_STATE_CLEANUP:
+            record["state"] = flux.constants.FLUX_JOB_STATE_CLEANUP
+            record["t_cleanup"] = event.timestamp
+
+    def get(self, jobid):
+        """
+        Get a copy of a job record, or None if we don't have it.
+        """
+        if not self.ready:
+            return None
+        with self.lock:
+            record = self.jobs.get(int(jobid))
+            if record is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(record)
+
+    def list(
+        self,
+        userid=None,
+        limit=None,
+        states=0,
+        since=None,
+        until=None,
+        jobids=None,
+        before=None,
+    ):
+        """
+        List copies of job records, newest first.
+
+        States is a job state bitmask, since is the time a job last changed
+        (e.g., was submit, started running, or became inactive) and until bounds
+        the submit time. Before is a (submit time, id) to list jobs after (a
+        cursor). Given a set of job ids (e.g., the jobs a user owns) only those
+        are looked at, newest (largest id) first.
+        """
+        jobs = []
+        with self.lock:
+            if jobids is None:
+                records = reversed(self.jobs.values())
+            else:
+                records = (self.jobs.get(x) for x in sorted(jobids, reverse=True))
+            for record in records:
+                if record is None:
+                    continue
+                if limit and len(jobs) >= limit:
+                    break
+                if userid is not None and record["userid"] != userid:
+                    continue
+                if states and not record["state"] & states:
+                    continue
+                if since is not None and get_changed_time(record) < since:
+                    continue
+                if until is not None and record["t_submit"] > until:
+                    continue
+                if before is not None and (record["t_submit"], record["id"]) >= before:
+                    continue
+                jobs.append(dict(record))
+            self.hits += 1
+        return jobs
+
+    def search(self, query, userid=None, jobids=None):
+        """
+        Get copies of the job records that match a search query, newest first.
+
+        Given a set of job ids, only matches among them are returned.
+        """
+        ids = self.index.search(query)
+        if jobids is not None:
+            ids &= jobids
+        jobs = []
+        with self.lock:
+            for jobid in sorted(ids, reverse=True):
+                record = self.jobs.get(jobid)
+                if record is None:
+                    continue
+                if userid is not None and record["userid"] != userid:
+                    continue
+                jobs.append(dict(record))
+            self.hits += 1
+        return jobs
+
+    def count(self, userid=None, jobids=None):
+        """
+        Count the jobs in the cache (optionally for one userid, or set of job ids)
+        """
+        with self.lock:
+            if jobids is not None:
+                records = [self.jobs[x] for x in jobids if x in self.jobs]
+                if userid is None:
+                    return len(records)
+                return sum(1 for record in records if record["userid"] == userid)
+            if userid is None:
+                return len(self.jobs)
+            return sum(1 for record in self.jobs.values() if record["userid"] == userid)
+
+    def stats(self):
+        """
+        Summary of the cache (size, readiness, and hits / misses).
+        """
+        return {
+            "enabled": self.enabled,
+            "ready": self.ready,
+            "size": self.size,
+            "jobs": len(self.jobs),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+job_cache = JobCache(size=settings.job_cache_size)
@@ -0,0 +1,210 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Prefix for the name of every metric
+namespace = "flux_restful"
+
+# Upper bounds (seconds) of latency histogram buckets
+latency_buckets = [
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+]
+
+# The text format served to Prometheus
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(names, values, extra=None):
+    """
+    Format label names and values, e.g., {route="/v1/jobs",method="GET"}
+    """
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    escaped = [
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in pairs
+    ]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    """
+    A count (by label values) that only goes up.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=None):
+        self.name = f"{namespace}_{name}"
+        self.help = help
+        self.labels = labels or []
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+
+        # A count without labels is there (as zero) before the first increment
+        if not self.labels and not values:
+            values[()] = 0
+        for labels, value in sorted(values.items()):
+            yield self.name + format_labels(self.labels, labels), value
+
+
+class Histogram:
+    """
+    Counts of observed values (e.g., latency) in buckets, by label values.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=None, buckets=None):
+        self.name = f"{namespace}_{name}"
+        self.help = help
+        self.labels = labels or []
+        self.buckets = buckets or latency_buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        """
+        Observe the seconds spent in the context.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        with self.lock:
+            values = {k: (list(v[0]), v[1], v[2]) for k, v in self.values.items()}
+        for labels, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, observed in zip(self.buckets + [float("inf")], counts + [0]):
+                cumulative += observed
+
+                # Values above the largest bucket are only in the +Inf bucket
+                if bound == float("inf"):
+                    cumulative = count
+                le = [("le", format_value(bound))]
+                name = self.name + "_bucket" + format_labels(self.labels, labels, le)
+                yield name, cumulative
+            yield self.name + "_sum" + format_labels(self.labels, labels), total
+            yield self.name + "_count" + format_labels(self.labels, labels), count
+
+
+requests = Counter(
+    "http_requests_total",
+    "HTTP requests by method, route, and status code.",
+    labels=["method", "route", "status"],
+)
+request_seconds = Histogram(
+    "http_request_duration_seconds",
+    "Seconds to answer HTTP requests (until the response starts), by method and route.",
+    labels=["method", "route"],
+)
+rpc_seconds = Histogram(
+    "flux_rpc_duration_seconds",
+    "Seconds spent on Flux requests, by topic.",
+    labels=["topic"],
+)
+rpc_errors = Counter(
+    "flux_rpc_errors_total", "Flux requests that failed, by topic.", labels=["topic"]
+)
+jobs_submitted = Counter("jobs_submitted_total", "Jobs submitted to Flux.")
+submit_errors = Counter("submit_errors_total", "Job submissions that failed.")
+
+registry = [
+    requests,
+    request_seconds,
+    rpc_seconds,
+    rpc_errors,
+    jobs_submitted,
+    submit_errors,
+]
+
+
+@contextmanager
+def time_rpc(topic):
+    """
+    Time a Flux request (or a watch) by topic, counting it as an error if it raises.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        rpc_errors.inc(topic)
+        raise
+    finally:
+        rpc_seconds.observe(time.perf_counter() - start, topic)
+
+
+def flatten_stats(stats, prefix=namespace):
+    """
+    Get (name, value) gauges for the numbers in nested statistics.
+    """
+    for key, value in stats.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            yield from flatten_stats(value, name)
+        elif isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+def render(stats=None):
+    """
+    Render all metrics (and statistics as gauges) in the Prometheus text format.
+    """
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, value in metric.samples():
+            lines.append(f"{name} {format_value(value)}")
+    for name, value in flatten_stats(stats or {}):
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {format_value(value)}")
+    return "\n".join(lines) + "\n"
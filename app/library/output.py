@@ -0,0 +1,340 @@
+import collections
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import flux.job
+
+import app.library.metrics as metrics
+from app.core.config import settings
+from app.library.handles import output_handles
+
+logger = logging.getLogger(__name__)
+
+# Seconds without a new output event before a snapshot read stops waiting
+snapshot_timeout = 0.1
+
+
+class JobOutput:
+    """
+    The output lines of a job, and their size in bytes.
+
+    Lines are the data of output events (the unit the API has always
+    returned), and offsets are line numbers.
+    """
+
+    def __init__(self, lines=None, complete=False):
+        self.lines = []
+        self.size = 0
+        self.complete = complete
+        for line in lines or []:
+            self.append(line)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def append(self, line):
+        self.lines.append(line)
+        self.size += len(line.encode("utf-8"))
+
+    def range(self, offset=0, limit=None, tail=None):
+        """
+        Get a range of lines: from an offset, or the last lines (tail).
+
+        Returns the lines, the offset of the first line, and the next offset.
+        """
+        if tail is not None:
+            offset = max(len(self.lines) - tail, 0)
+        offset = min(max(offset or 0, 0), len(self.lines))
+        end = len(self.lines) if limit is None else min(offset + limit, len(self.lines))
+        return self.lines[offset:end], offset, end
+
+
+class OutputIndex:
+    """
+    A size bounded (least recently used) index of job output, by job id.
+
+    Only complete output (the job will not write more) is kept, so any range
+    of it can be served again without replaying the eventlog. The size is in
+    bytes of output, so a few jobs with a lot of output can't use all of
+    the memory, and output larger than the index is not kept.
+    """
+
+    def __init__(self, size=64 * 1024 * 1024):
+        self.size = size
+        self.outputs = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, jobid):
+        with self.lock:
+            output = self.outputs.get(int(jobid))
+            if output is None:
+                self.misses += 1
+                return None
+            self.outputs.move_to_end(int(jobid))
+            self.hits += 1
+            return output
+
+    def add(self, jobid, output):
+        if not output.complete or output.size > self.size:
+            return
+        jobid = int(jobid)
+        with self.lock:
+            previous = self.outputs.pop(jobid, None)
+            if previous is not None:
+                self.bytes -= previous.size
+            self.outputs[jobid] = output
+            self.bytes += output.size
+            while self.bytes > self.size:
+                _, evicted = self.outputs.popitem(last=False)
+                self.bytes -= evicted.size
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "bytes": self.bytes,
+            "jobs": len(self.outputs),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def encode_output(output):
+    """
+    Encode complete output as the (gzip compressed) json of an output response.
+
+    This is the body GET /v1/jobs/{uid}/output returns for all of the output,
+    so a client that accepts gzip can be sent the file as it is.
+    """
+    body = {
+        "Output": output.lines,
+        "offset": 0,
+        "next_offset": len(output),
+        "complete": True,
+    }
+    data = json.dumps(body, ensure_ascii=False, separators=(",", ":"))
+    return gzip.compress(data.encode("utf-8"))
+
+
+class OutputCache:
+    """
+    A size bounded (least recently used) cache of complete job output on disk.
+
+    Each job is one gzip compressed file, written once when we first read
+    all of its output, so a later request for the output of a finished job
+    does not replay its eventlog (or the bytes it takes in memory). Files can
+    be sent as they are with Content-Encoding: gzip. Workers can share a
+    directory, and a file written by another worker is adopted when it is
+    first read. Job ids start over in a new instance, so files are kept in a
+    directory for the instance (by its start time), and the files of other
+    instances are removed when we start.
+    """
+
+    suffix = ".json.gz"
+
+    def __init__(self, root=None, size=1024 * 1024 * 1024):
+        self.root = root
+        self.size = size
+        self.files = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.instance = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return bool(self.root) and self.size > 0
+
+    @property
+    def directory(self):
+        return os.path.join(self.root, self.instance)
+
+    def path(self, jobid):
+        return os.path.join(
+            self.directory, f"{int(flux.job.JobID(jobid))}{self.suffix}"
+        )
+
+    def load(self):
+        """
+        Create the directory for the instance, remove those of other instances,
+        and account for files already in it (oldest first).
+        """
+        if self.loaded:
+            return
+        self.instance = output_handles.instance()
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name == self.instance:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.endswith(self.suffix):
+                os.remove(path)
+
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.files[name] = size
+            self.bytes += size
+        self.loaded = True
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used files until we are within size (lock held).
+        """
+        while self.bytes > self.size and self.files:
+            name, size = self.files.popitem(last=False)
+            self.bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def add(self, jobid, output):
+        """
+        Write the output of a job (if it is complete, and not empty).
+        """
+        if not self.enabled or not output.complete or not len(output):
+            return
+        try:
+            with self.lock:
+                self.load()
+            path = self.path(jobid)
+            data = encode_output(output)
+
+            # Write to a temporary file first, so a reader never sees part of one
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    out.write(data)
+                os.replace(tmp, path)
+            except Exception:
+                os.remove(tmp)
+                raise
+        except Exception as e:
+            logger.warning(f"Cannot cache output of job {jobid}: {e}")
+            return
+
+        name = os.path.basename(path)
+        with self.lock:
+            self.bytes += len(data) - self.files.pop(name, 0)
+            self.files[name] = len(data)
+            self.evict()
+
+    def read(self, jobid):
+        """
+        Get the compressed output response of a job, or None if we don't have it.
+        """
+        if not self.enabled:
+            return None
+        try:
+            with self.lock:
+                self.load()
+            path = self.path(jobid)
+            with open(path, "rb") as fd:
+                data = fd.read()
+        except Exception:
+            self.misses += 1
+            return None
+
+        name = os.path.basename(path)
+        with self.lock:
+            if name not in self.files:
+                self.bytes += len(data)
+                self.files[name] = len(data)
+            self.files.move_to_end(name)
+            self.hits += 1
+        return data
+
+    def get(self, jobid):
+        """
+        Get the (complete) output of a job, or None if we don't have it.
+        """
+        data = self.read(jobid)
+        if data is None:
+            return None
+        try:
+            body = json.loads(gzip.decompress(data))
+        except Exception as e:
+            logger.warning(f"Cannot read cached output of job {jobid}: {e}")
+            return None
+        return JobOutput(body["Output"], complete=True)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "size": self.size,
+            "bytes": self.bytes,
+            "jobs": len(self.files),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def read_output(handle, jobid, stop=None, timeout=None):
+    """
+    Read the output of a job from the guest.output eventlog.
+
+    Reading ends when the output is complete (it is then marked complete),
+    when stop(output) is true, or, given a timeout, when no new event arrives
+    within it (a snapshot of an active job). Errors are counted (as failed
+    event_watch requests) and end the read with the output we have.
+    """
+    output = JobOutput()
+    try:
+        watcher = flux.job.event_watch_async(handle, jobid, "guest.output")
+    except Exception:
+        metrics.rpc_errors.inc("event_watch")
+        return output
+
+    try:
+        while not (stop and stop(output)):
+            if timeout is not None:
+                watcher.wait_for(timeout)
+            event = watcher.get_event()
+            if event is None:
+                output.complete = True
+                return output
+            if "data" in event.context:
+                output.append(event.context["data"])
+
+    # A timeout means we caught up
+    except TimeoutError:
+        pass
+
+    # e.g., the job or its output does not exist (yet)
+    except Exception:
+        metrics.rpc_errors.inc("event_watch")
+
+    # We stopped early, so the watch needs to be cancelled
+    try:
+        watcher.cancel()
+        while watcher.get_event() is not None:
+            pass
+    except Exception:
+        pass
+    return output
+
+
+output_index = OutputIndex(size=settings.output_index_size * 1024 * 1024)
+output_cache = OutputCache(
+    root=settings.output_cache_dir, size=settings.output_cache_size * 1024 * 1024
+)
@@ -0,0 +1,176 @@
+import collections
+import logging
+import threading
+
+import flux.job
+
+import app.library.metrics as metrics
+from app.core.config import settings
+from app.library.handles import handles
+from app.library.jobcache import job_cache
+
+logger = logging.getLogger(__name__)
+
+
+def get_owner(user):
+    """
+    Get the (name, is_superuser) of a requesting user.
+
+    Without authentication there is no user, and every job is visible. The
+    API and the web interface both give us the identity of the user from
+    the database, and a plain user name is never a superuser.
+    """
+    if user is None:
+        return None, True
+    if hasattr(user, "user_name"):
+        return user.user_name, bool(user.is_superuser)
+    return str(user), False
+
+
+def get_jobspec_owner(jobspec):
+    """
+    Get the owning user attribute that prepare_job sets on a jobspec (if any)
+    """
+    return (jobspec or {}).get("attributes", {}).get("system", {}).get("user")
+
+
+class OwnerIndex:
+    """
+    An index of job owners: job id to owner name, and owner to job ids.
+
+    The owner is the "user" attribute that prepare_job sets on the jobspec.
+    It is added when we submit a job, and for every job in the journal (by
+    the job cache), so checking who owns a job, or listing the jobs of one
+    user, does not look at anyone else's jobs. Jobs we did not hear about
+    (submit by another worker without the job cache, or before we started)
+    are looked up by their jobspec the first time we see them.
+
+    The index keeps at most size jobs, and forgets the least recently used
+    (or purged) ones. A job we forgot is looked up again when asked for.
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+
+        # Job id to owner (None if it has none), and owner to job ids
+        self.owners = collections.OrderedDict()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.evictions = 0
+
+    def add(self, jobid, owner):
+        """
+        Add the owner of a job (None remembers that it has none).
+        """
+        jobid = int(flux.job.JobID(jobid))
+        with self.lock:
+            # An owner we know is not forgotten for a job that has none
+            if jobid in self.owners and not owner:
+                self.owners.move_to_end(jobid)
+                return
+            if jobid in self.owners:
+                self.discard(jobid)
+            self.owners[jobid] = owner
+            if owner:
+                self.jobs.setdefault(owner, set()).add(jobid)
+            while len(self.owners) > self.size:
+                self.discard(next(iter(self.owners)))
+                self.evictions += 1
+
+    def discard(self, jobid):
+        """
+        Forget the owner of a job (lock held).
+        """
+        owner = self.owners.pop(jobid, None)
+        if owner:
+            self.jobs[owner].discard(jobid)
+            if not self.jobs[owner]:
+                del self.jobs[owner]
+
+    def remove(self, jobid):
+        with self.lock:
+            self.discard(int(flux.job.JobID(jobid)))
+
+    def owner(self, jobid):
+        """
+        Get the owner of a job, or None if we don't know it.
+        """
+        jobid = int(flux.job.JobID(jobid))
+        with self.lock:
+            if jobid not in self.owners:
+                return None
+            self.owners.move_to_end(jobid)
+            return self.owners[jobid]
+
+    def lookup(self, jobids):
+        """
+        Read the owners of jobs we don't know from their jobspecs.
+
+        The job cache tells us about new jobs, so this is for older jobs (and
+        those we forgot). Jobs without an owner are remembered as such.
+        """
+        with self.lock:
+            missing = {int(flux.job.JobID(x)) for x in jobids}
+            missing = {x for x in missing if x not in self.owners}
+        if not missing:
+            return
+        try:
+            with handles.handle() as handle, metrics.time_rpc("job-info.lookup"):
+                lookup = flux.job.JobKVSLookup(handle, ids=sorted(missing))
+                found = lookup.data()
+        except Exception as e:
+            logger.warning(f"Cannot look up the owners of {len(missing)} jobs: {e}")
+            return
+        self.lookups += 1
+        for job in found:
+            self.add(job["id"], get_jobspec_owner(job.get("jobspec")))
+
+    def jobids(self, owner):
+        """
+        Get (a copy of) the set of job ids a user owns.
+        """
+        with self.lock:
+            return set(self.jobs.get(owner, ()))
+
+    def allowed(self, user):
+        """
+        Get the job ids a user can see, or None if they can see all jobs.
+        """
+        name, is_superuser = get_owner(user)
+        if is_superuser:
+            return None
+        return self.jobids(name)
+
+    def can_access(self, jobid, user):
+        """
+        Determine if a user can see (and act on) a job.
+        """
+        name, is_superuser = get_owner(user)
+        if is_superuser:
+            return True
+        try:
+            if self.owner(jobid) is None:
+                self.lookup([jobid])
+            return self.owner(jobid) == name
+        except Exception:
+            return False
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "jobs": len(self.owners),
+            "owners": len(self.jobs),
+            "lookups": self.lookups,
+            "evictions": self.evictions,
+        }
+
+
+owner_index = OwnerIndex(size=settings.owner_index_size)
+
+# Jobs submit by anyone (or before we started) come from the journal
+job_cache.add_listener(
+    lambda record: owner_index.add(record["id"], job_cache.owner(record["id"])),
+    "submit",
+)
+job_cache.add_listener(lambda record: owner_index.remove(record["id"]), "invalidate")
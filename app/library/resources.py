@@ -0,0 +1,302 @@
+import collections
+import logging
+import threading
+import time
+
+import flux
+import flux.resource
+from flux.idset import IDset
+
+import app.library.metrics as metrics
+from app.library.handles import handles
+from app.library.jobcache import job_cache
+
+logger = logging.getLogger(__name__)
+
+
+def get_node_state(rank, status):
+    """
+    Get the state of one node (broker rank) from a resource status.
+
+    Allocation changes with every job, so it is not part of this state (see
+    ResourceCache.get), and a node that is neither down nor drained is up.
+    """
+    if rank in status.offline or rank in status.exclude:
+        return "down"
+    if rank in status.drained or rank in status.draining:
+        return "drained"
+    return "up"
+
+
+def get_inventory(status):
+    """
+    Build a listing of nodes (name, rank, cores, gpus, and state) from a resource status.
+    """
+    nodes = []
+    for rank, name in zip(status.all, status.nodelist):
+        rset = status.rset.copy_ranks(rank)
+        nodes.append(
+            {
+                "name": str(name),
+                "rank": rank,
+                "cores": rset.ncores,
+                "gpus": rset.ngpus,
+                "state": get_node_state(rank, status),
+            }
+        )
+    return {
+        "nodes": nodes,
+        "cores": status.rset.ncores,
+        "gpus": status.rset.ngpus,
+        "capacity": get_capacity(nodes, status.exclude),
+    }
+
+
+def set_allocated(inventory, allocated):
+    """
+    Get a copy of an inventory with the nodes in a set of ranks allocated.
+    """
+    nodes = []
+    for node in inventory["nodes"]:
+        if node["state"] == "up" and node["rank"] in allocated:
+            node = dict(node, state="allocated")
+        nodes.append(node)
+    return dict(inventory, nodes=nodes)
+
+
+def parse_ranks(ranks):
+    """
+    Parse the ranks of a job record (e.g., "0-3,5") into a set of integers.
+    """
+    return {int(x) for x in IDset(ranks)} if ranks else set()
+
+
+def get_capacity(nodes, exclude=()):
+    """
+    The most a job can ask for: nodes, cores and gpus (in total, and on one node).
+
+    Nodes that are down or drained can come back, so only nodes excluded by
+    configuration don't count.
+    """
+    nodes = [x for x in nodes if x["rank"] not in exclude]
+    return {
+        "nodes": len(nodes),
+        "cores": sum(x["cores"] for x in nodes),
+        "gpus": sum(x["gpus"] for x in nodes),
+        "cores_per_node": max([x["cores"] for x in nodes], default=0),
+        "gpus_per_node": max([x["gpus"] for x in nodes], default=0),
+    }
+
+
+class ResourceCache:
+    """
+    The resources of the instance (a node inventory), kept until they change.
+
+    Resources rarely change, so the inventory is built once from a resource
+    status query and served from memory. A background thread follows the
+    resource journal (drain, undrain, online, offline, etc.) and marks the
+    inventory stale, so the next request builds it again. Without the journal
+    (e.g., an older Flux) the inventory is kept for ttl seconds instead.
+
+    Which nodes are allocated changes with every job, so it is not part of the
+    inventory: the ranks of each running job are counted from the alloc and
+    free events of the job cache. Until the job cache is ready, the allocated
+    ranks from the last query are used (for at most ttl seconds).
+
+    The capacity (what a job can ask for) does not depend on allocations, so
+    it is kept separately and only the background thread queries it: after
+    resource journal events, or every ttl seconds without the journal. Asking
+    for it never waits on the broker.
+    """
+
+    def __init__(self, ttl=10):
+        self.ttl = ttl
+        self.inventory = None
+        self.updated = 0
+        self.stale = True
+        self.limits = None
+        self.limits_stale = True
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.refreshes = 0
+        self.invalidations = 0
+        self.following = False
+
+        # Allocated ranks from the last query, and counted from job events
+        self.allocated = set()
+        self.jobs = {}
+        self.ranks = collections.Counter()
+        self.jobs_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return hasattr(flux.resource, "ResourceJournalConsumer")
+
+    def start(self):
+        """
+        Start keeping the capacity current in a background thread.
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self.run, name="flux-resource-cache", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread = None
+        self.following = False
+
+    def run(self):
+        """
+        Consume resource journal events (or poll), reconnecting on error.
+        """
+        while not self._stopped.is_set():
+            try:
+                if self.enabled:
+                    self.follow()
+                else:
+                    self.refresh_limits()
+                    self._stopped.wait(self.ttl)
+                    continue
+            except Exception as e:
+                logger.warning(f"Resource cache lost the journal, reconnecting: {e}")
+            self.following = False
+            self._stopped.wait(1.0)
+
+    def follow(self):
+        """
+        Follow the resource journal, querying the capacity when it is quiet.
+        """
+        consumer = flux.resource.ResourceJournalConsumer(
+            flux.Flux(), include_sentinel=True
+        ).start()
+        while not self._stopped.is_set():
+            try:
+                event = consumer.poll(timeout=1.0)
+            except TimeoutError:
+                event = False
+            if event is None:
+                break
+
+            if event:
+                # Anything before the sentinel happened before we looked
+                if event.is_empty():
+                    self.following = True
+                self.invalidate()
+                self.limits_stale = True
+                continue
+            if self.following and self.limits_stale:
+                self.refresh_limits()
+
+    def refresh_limits(self):
+        """
+        Query the resources (from the background thread) to update the capacity.
+        """
+        self.limits_stale = False
+        try:
+            with self.lock:
+                self.refresh()
+        except Exception as e:
+            self.limits_stale = True
+            logger.warning(f"Cannot get resource capacity: {e}")
+
+    def invalidate(self, *args):
+        """
+        Mark the inventory stale (it is built again when next asked for).
+        """
+        self.stale = True
+        self.invalidations += 1
+
+    def alloc(self, record):
+        """
+        Count the ranks of a job that was allocated resources.
+        """
+        ranks = parse_ranks(record.get("ranks"))
+        with self.jobs_lock:
+            if record["id"] in self.jobs:
+                return
+            self.jobs[record["id"]] = ranks
+            self.ranks.update(ranks)
+
+    def free(self, record):
+        """
+        Stop counting the ranks of a job that freed its resources.
+        """
+        with self.jobs_lock:
+            ranks = self.jobs.pop(record["id"], set())
+            self.ranks.subtract(ranks)
+            for rank in ranks:
+                if self.ranks[rank] <= 0:
+                    del self.ranks[rank]
+
+    def get(self):
+        """
+        Get the node inventory, building it if we don't have a current one.
+        """
+        self.start()
+        with self.lock:
+            # The job cache tells us about allocations, otherwise we ask again
+            counting = job_cache.ready
+            expired = time.time() - self.updated > self.ttl
+            if not self.following or not counting:
+                self.stale = self.stale or expired
+            if self.inventory is None or self.stale:
+                self.refresh()
+            else:
+                self.hits += 1
+            inventory = self.inventory
+
+        if not counting:
+            return set_allocated(inventory, self.allocated)
+        with self.jobs_lock:
+            allocated = set(self.ranks)
+        return set_allocated(inventory, allocated)
+
+    def refresh(self):
+        """
+        Build the inventory (and capacity) from a resource status query.
+        """
+        # Mark it current first, so a change while we query is not lost
+        self.stale = False
+        try:
+            with handles.handle() as handle, metrics.time_rpc("resource.status"):
+                status = flux.resource.resource_status(handle).get()
+            self.inventory = get_inventory(status)
+        except Exception:
+            self.stale = True
+            raise
+        self.allocated = set(status.allocated)
+        self.limits = self.inventory["capacity"]
+        self.updated = time.time()
+        self.refreshes += 1
+        return self.inventory
+
+    def capacity(self):
+        """
+        Get the capacity of the instance, or None if we don't know it yet.
+        """
+        self.start()
+        return self.limits
+
+    def stats(self):
+        return {
+            "following": self.following,
+            "capacity": self.limits is not None,
+            "nodes": len(self.inventory["nodes"]) if self.inventory else 0,
+            "allocated": len(self.ranks),
+            "hits": self.hits,
+            "refreshes": self.refreshes,
+            "invalidations": self.invalidations,
+        }
+
+
+resource_cache = ResourceCache()
+
+# A job being allocated (or freed) changes which nodes are allocated
+job_cache.add_listener(resource_cache.alloc, "alloc")
+job_cache.add_listener(resource_cache.free, "free")
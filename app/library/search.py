@@ -0,0 +1,201 @@
+import bisect
+import functools
+import pwd
+import re
+import threading
+
+import flux.constants
+import flux.job
+from flux.hostlist import Hostlist
+
+# Fields that can be used to qualify a query term (e.g., state:run)
+fields = ["name", "user", "state", "nodelist", "result", "id"]
+
+# Virtual states that also match a job in one of these states
+virtual_states = {
+    "pending": flux.constants.FLUX_JOB_STATE_PENDING,
+    "running": flux.constants.FLUX_JOB_STATE_RUNNING,
+    "active": flux.constants.FLUX_JOB_STATE_ACTIVE,
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def get_username(userid):
+    """
+    Look up (and remember) a user name for a userid
+    """
+    try:
+        return pwd.getpwuid(userid).pw_name
+    except (KeyError, TypeError):
+        return str(userid)
+
+
+def split_words(value):
+    """
+    A value and the lowercase words in it, e.g., "lmp-run" -> lmp-run, lmp, run
+    """
+    value = str(value).lower()
+    return {value} | {word for word in re.split("[^a-z0-9]+", value) if word}
+
+
+def job_tokens(job, owner=None):
+    """
+    Get the searchable tokens for each field of a raw job record.
+
+    The owner (the user attribute of the jobspec) is not part of a job-list
+    record, so it is given separately.
+    """
+    tokens = {field: set() for field in fields}
+    jobid = flux.job.JobID(job["id"])
+    tokens["id"] = {str(int(jobid)), jobid.f58.lower()}
+
+    if job.get("name"):
+        tokens["name"] = split_words(job["name"])
+    if owner:
+        tokens["user"].add(str(owner).lower())
+    if job.get("userid") is not None:
+        tokens["user"].add(get_username(job["userid"]).lower())
+
+    state = job.get("state")
+    if isinstance(state, int):
+        tokens["state"].add(flux.job.info.statetostr(state).lower())
+        for name, mask in virtual_states.items():
+            if state & mask:
+                tokens["state"].add(name)
+
+    result = job.get("result")
+    if isinstance(result, int):
+        tokens["result"].add(flux.job.info.resulttostr(result).lower())
+
+    if job.get("nodelist"):
+        try:
+            tokens["nodelist"] = {host.lower() for host in Hostlist(job["nodelist"])}
+        except ValueError:
+            tokens["nodelist"] = {job["nodelist"].lower()}
+    return tokens
+
+
+def parse_query(query):
+    """
+    Parse a query like 'state:run user:alice name:lammps*' into terms.
+
+    Each term is (field, value, is_prefix), where a field of None matches
+    any field. All terms must match. A term without a field matches the
+    start of a word (as someone types), and text before a colon that is
+    not a field (e.g., a time like 10:30) is part of a plain term.
+    """
+    terms = []
+    for word in (query or "").split():
+        field = None
+        if ":" in word and word.split(":", 1)[0].lower() in fields:
+            field, word = word.split(":", 1)
+            field = field.lower()
+        is_prefix = field is None or word.endswith("*")
+        value = word.rstrip("*").lower()
+        if not value and not is_prefix:
+            continue
+        terms.append((field, value, is_prefix))
+    return terms
+
+
+class JobIndex:
+    """
+    An inverted index from (field, token) to job ids.
+
+    Exact terms are one dictionary lookup, and prefix terms (ending in *)
+    bisect a sorted list of the field's tokens, so the cost of a search
+    depends on the number of matches and not the number of jobs.
+    """
+
+    def __init__(self):
+        self.postings = {field: {} for field in fields}
+        self.sorted_tokens = {field: [] for field in fields}
+        self.documents = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, job, owner=None):
+        """
+        Add (or re-index) a raw job record (and its owner).
+        """
+        jobid = int(job["id"])
+        tokens = job_tokens(job, owner=owner)
+        with self.lock:
+            previous = self.documents.get(jobid, {})
+            for field in fields:
+                old = previous.get(field, set())
+                new = tokens[field]
+                for token in old - new:
+                    self._unpost(field, token, jobid)
+                for token in new - old:
+                    self._post(field, token, jobid)
+            self.documents[jobid] = tokens
+
+    def remove(self, jobid):
+        """
+        Remove a job from the index.
+        """
+        jobid = int(jobid)
+        with self.lock:
+            tokens = self.documents.pop(jobid, {})
+            for field, values in tokens.items():
+                for token in values:
+                    self._unpost(field, token, jobid)
+
+    def _post(self, field, token, jobid):
+        postings = self.postings[field]
+        if token not in postings:
+            postings[token] = set()
+            bisect.insort(self.sorted_tokens[field], token)
+        postings[token].add(jobid)
+
+    def _unpost(self, field, token, jobid):
+        postings = self.postings[field]
+        ids = postings.get(token)
+        if ids is None:
+            return
+        ids.discard(jobid)
+        if not ids:
+            del postings[token]
+            tokens = self.sorted_tokens[field]
+            del tokens[bisect.bisect_left(tokens, token)]
+
+    def lookup(self, field, value, is_prefix=False):
+        """
+        Get the job ids with a token (or token prefix) in a field.
+        """
+        postings = self.postings[field]
+        if not is_prefix:
+            return set(postings.get(value, ()))
+        ids = set()
+        tokens = self.sorted_tokens[field]
+        i = bisect.bisect_left(tokens, value)
+        while i < len(tokens) and tokens[i].startswith(value):
+            ids |= postings[tokens[i]]
+            i += 1
+        return ids
+
+    def search(self, query):
+        """
+        Get the set of job ids that match all terms of a query.
+        """
+        terms = parse_query(query)
+        with self.lock:
+            if not terms:
+                return set(self.documents)
+            matches = []
+            for field, value, is_prefix in terms:
+                search_fields = [field] if field else fields
+                ids = set()
+                for name in search_fields:
+                    ids |= self.lookup(name, value, is_prefix)
+                matches.append(ids)
+
+        # Intersect starting with the smallest set
+        matches.sort(key=len)
+        ids = matches[0]
+        for other in matches[1:]:
+            ids &= other
+        return ids
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import struct
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sign_script = os.path.join(root, "scripts", "sign-job.py")
+
+# Each frame is a 4 byte (big endian) length followed by json
+header = struct.Struct(">I")
+
+
+class SignHelper:
+    """
+    A long running "flux python sign-job.py --serve" process to sign jobs.
+
+    Starting an interpreter and importing flux for every multi-user submit
+    is slow, so one helper per worker signs jobspecs on behalf of users
+    (sign_wrap_as) and each submit costs one round trip on its pipes. The
+    helper is started on first use, and again if it exits.
+    """
+
+    def __init__(self, command=None):
+        self.command = command or ["flux", "python", sign_script, "--serve"]
+        self.process = None
+        self.lock = threading.Lock()
+        self.signed = 0
+        self.restarts = 0
+
+    def start(self):
+        """
+        Start the helper process (with the lock held).
+        """
+        if self.process is not None:
+            self.restarts += 1
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=os.environ,
+        )
+
+    def close(self):
+        """
+        Stop the helper (closing stdin asks it to exit).
+        """
+        with self.lock:
+            if self.process is None:
+                return
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except Exception:
+                self.process.kill()
+            self.process = None
+
+    def request(self, message):
+        """
+        Send one request frame and read the response (with the lock held).
+        """
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        data = json.dumps(message).encode("utf-8")
+        self.process.stdin.write(header.pack(len(data)) + data)
+        self.process.stdin.flush()
+
+        size = self.process.stdout.read(header.size)
+        if len(size) < header.size:
+            raise BrokenPipeError("The job signing helper exited.")
+        return json.loads(self.process.stdout.read(header.unpack(size)[0]))
+
+    def sign(self, userid, payload):
+        """
+        Sign a jobspec (json string) as a user, returning the signed J.
+        """
+        message = {"userid": userid, "payload": payload}
+        with self.lock:
+            try:
+                response = self.request(message)
+            except (BrokenPipeError, OSError) as e:
+                # Try once more with a new helper
+                logger.warning(f"Restarting job signing helper: {e}")
+                if self.process is not None:
+                    self.process.kill()
+                self.start()
+                response = self.request(message)
+        if "error" in response:
+            raise ValueError(f"Cannot sign job for user {userid}: {response['error']}")
+        self.signed += 1
+        return response["signed"]
+
+    def stats(self):
+        return {
+            "running": self.process is not None and self.process.poll() is None,
+            "signed": self.signed,
+            "restarts": self.restarts,
+        }
+
+
+signer = SignHelper()
@@ -0,0 +1,419 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+
+import flux
+import flux.constants
+import flux.job
+
+import app.library.metrics as metrics
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Known output streams a subscriber can ask for
+stream_names = ["stdout", "stderr"]
+
+
+class Subscriber:
+    """
+    One client following the output of a job (e.g., a server sent events stream).
+
+    Output already received for the job when the client joins is read from the
+    job broadcast it shares with other clients, and new events are delivered
+    from the reactor thread into a bounded asyncio queue. A client that falls
+    so far behind that the queue fills is sent "overflow" and can reconnect
+    from the last event id it received.
+    """
+
+    def __init__(self, jobid, streams=None, after=-1, size=1000):
+        self.jobid = flux.job.JobID(jobid)
+        self.streams = streams
+        self.after = after
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=size)
+        self.closed = False
+        self.overflowed = False
+
+        # Output events to replay (shared with the broadcast), the id of the
+        # first, and our position (by event id)
+        self.history = []
+        self.first = 0
+        self.position = 0
+        self.replay_end = 0
+        self.broadcast = None
+
+    def wants(self, payload):
+        """
+        Determine if an output event is after the last one the client saw,
+        and on a stream it asked for.
+        """
+        if payload["id"] <= self.after:
+            return False
+        return not self.streams or payload["stream"] in self.streams
+
+    def publish(self, kind, payload=None):
+        """
+        Deliver an event to the client (called from the reactor thread)
+        """
+        if kind == "output" and not self.wants(payload):
+            return
+        self.loop.call_soon_threadsafe(self._put, (kind, payload))
+
+    def _put(self, item):
+        if self.closed or self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def next(self, timeout=None):
+        """
+        Get the next (kind, payload) event, or a ping if nothing came in time.
+        """
+        while True:
+            while self.position < self.replay_end:
+                payload = self.history[self.position - self.first]
+                self.position += 1
+                if self.wants(payload):
+                    return "output", payload
+            self.history = []
+
+            if self.overflowed and self.queue.empty():
+                return "overflow", None
+            try:
+                kind, payload = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                return "ping", None
+
+            # The output received before we joined, to read before new events
+            if kind == "replay":
+                self.history, self.first, self.replay_end = payload
+                self.position = max(self.after + 1, self.first)
+                continue
+            return kind, payload
+
+
+class Broadcast:
+    """
+    One upstream watch of a job's output, shared by all of its subscribers.
+
+    The last history output events are kept for subscribers that join late.
+    A subscriber that needs events older than that gets a watch of its own
+    (see OutputStreams.watch) that reads the eventlog from the start.
+    """
+
+    def __init__(self, jobid, history=10000, shared=True):
+        self.jobid = jobid
+        self.future = None
+        self.subscribers = set()
+        self.history = history
+        self.shared = shared
+
+        # Output events received (since the first we kept), and the next id
+        self.events = []
+        self.first = 0
+        self.count = 0
+        self.done = False
+
+    def can_join(self, subscriber):
+        """
+        Determine if we still have every event a subscriber needs.
+        """
+        return subscriber.after + 1 >= self.first
+
+    def join(self, subscriber):
+        self.subscribers.add(subscriber)
+        subscriber.broadcast = self
+        subscriber.publish("replay", (self.events, self.first, self.count))
+        if self.done:
+            subscriber.publish("done")
+
+    def add(self, payload):
+        """
+        Keep an output event, dropping the oldest when we have twice the history.
+
+        The list is replaced (not changed), since subscribers may be replaying it.
+        """
+        self.count += 1
+        if not self.shared:
+            return
+        self.events.append(payload)
+        if len(self.events) >= 2 * self.history:
+            self.events = self.events[-self.history :]
+            self.first = self.count - len(self.events)
+
+    def publish(self, kind, payload=None):
+        for subscriber in self.subscribers:
+            subscriber.publish(kind, payload)
+
+
+class OutputStreams:
+    """
+    Watch job output for all stream subscribers of a worker from one thread.
+
+    The thread runs a Flux reactor with one asynchronous watch per job, so a
+    client waiting on a quiet job does not hold a blocked thread, and many
+    clients following the same job share a single watch on the broker. The
+    watch is cancelled when the last subscriber for the job leaves. Requests
+    to (un)subscribe are queued and the reactor is woken up through a pipe.
+    """
+
+    def __init__(self, queue_size=1000, history=10000):
+        self.queue_size = queue_size
+        self.history = history
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.wakeup = None
+        self.subscribers = 0
+
+        # Broadcasts by job id (owned by the reactor thread)
+        self.jobs = {}
+
+    def start(self):
+        """
+        Start the reactor thread (if it is not running yet)
+        """
+        with self.lock:
+            if self.thread is not None:
+                return
+            read_fd, self.wakeup = os.pipe()
+            self.thread = threading.Thread(
+                target=self.run,
+                args=(read_fd,),
+                name="flux-output-streams",
+                daemon=True,
+            )
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stop the reactor thread
+        """
+        if self.thread is not None:
+            self.request("stop")
+
+    def run(self, read_fd):
+        error = None
+        try:
+            handle = flux.Flux()
+            watcher = handle.fd_watcher_create(
+                read_fd, self.service, events=flux.constants.FLUX_POLLIN
+            )
+            watcher.start()
+            handle.reactor_run()
+            watcher.stop()
+        except Exception as e:
+            metrics.rpc_errors.inc("event_watch")
+            error = {"Message": f"Cannot follow job output: {e}"}
+            logger.warning(error["Message"])
+
+        # Subscribers still waiting (or that asked meanwhile) hear about it
+        with self.lock:
+            self.thread = None
+            os.close(read_fd)
+            os.close(self.wakeup)
+            self.wakeup = None
+            broadcasts = list(self.jobs.values())
+            self.jobs = {}
+            requests = []
+            while not self.requests.empty():
+                requests.append(self.requests.get_nowait())
+        for broadcast in broadcasts:
+            self.cancel(broadcast)
+            if error is not None:
+                broadcast.publish("error", error)
+        for action, subscriber in requests:
+            if action == "subscribe" and subscriber is not None:
+                subscriber.publish("error", error or {"Message": "Stopped."})
+
+    def request(self, action, subscriber=None):
+        """
+        Queue a request for the reactor thread, and wake it up.
+        """
+        with self.lock:
+            if self.wakeup is None:
+                if action == "subscribe":
+                    subscriber.publish("error", {"Message": "Output streams stopped."})
+                return
+            self.requests.put((action, subscriber))
+            os.write(self.wakeup, b"\0")
+
+    def service(self, handle, watcher, fd, revents, args):
+        """
+        Handle queued requests (in the reactor thread)
+        """
+        os.read(fd, 4096)
+        while True:
+            try:
+                action, subscriber = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if action == "subscribe":
+                self.watch(handle, subscriber)
+            elif action == "unsubscribe":
+                self.unwatch(subscriber)
+            elif action == "stop":
+                handle.reactor_stop()
+
+    def subscribe(self, jobid, streams=None, after=-1):
+        """
+        Start following the output of a job, after an (optional) event id.
+        """
+        self.start()
+        subscriber = Subscriber(jobid, streams, after, size=self.queue_size)
+        with self.lock:
+            self.subscribers += 1
+        self.request("subscribe", subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """
+        Stop following output (when the client goes away)
+        """
+        if subscriber.closed:
+            return
+        subscriber.closed = True
+        with self.lock:
+            self.subscribers -= 1
+        self.request("unsubscribe", subscriber)
+
+    def watch(self, handle, subscriber):
+        """
+        Add a subscriber to the broadcast for its job, starting the watch if needed.
+        """
+        if subscriber.closed:
+            return
+        jobid = int(subscriber.jobid)
+        broadcast = self.jobs.get(jobid)
+
+        # Output older than the broadcast keeps is read again, for this subscriber
+        shared = broadcast is None or broadcast.can_join(subscriber)
+        if broadcast is None or not shared:
+            broadcast = Broadcast(jobid, history=self.history, shared=shared)
+            try:
+                broadcast.future = flux.job.event_watch_async(
+                    handle, jobid, "guest.output"
+                )
+                broadcast.future.then(self.on_event, broadcast)
+            except Exception as e:
+                metrics.rpc_errors.inc("event_watch")
+                subscriber.publish("error", {"Message": str(e)})
+                return
+            if shared:
+                self.jobs[jobid] = broadcast
+        broadcast.join(subscriber)
+
+    def unwatch(self, subscriber):
+        """
+        Remove a subscriber, and the watch for its job if it was the last one.
+        """
+        broadcast = subscriber.broadcast
+        if broadcast is None:
+            return
+        broadcast.subscribers.discard(subscriber)
+        if not broadcast.subscribers:
+            self.cancel(broadcast)
+
+    def cancel(self, broadcast):
+        """
+        Cancel the upstream watch of a broadcast (if still running) and drop it.
+        """
+        if self.jobs.get(broadcast.jobid) is broadcast:
+            del self.jobs[broadcast.jobid]
+        if broadcast.future is None:
+            return
+        try:
+            broadcast.future.cancel()
+        except Exception as e:
+            logger.warning(f"Cannot cancel output watch for {broadcast.jobid}: {e}")
+        broadcast.future = None
+
+    def on_event(self, future, broadcast):
+        """
+        Fan out one guest.output event to the subscribers of a job (in the reactor thread)
+
+        Data events are numbered in eventlog order, so a client can resume
+        after the last id it saw.
+        """
+        # We cancelled the watch, and this is the end of it
+        if broadcast.future is None:
+            return
+        try:
+            event = future.get_event()
+        except Exception as e:
+            metrics.rpc_errors.inc("event_watch")
+            broadcast.future = None
+            broadcast.publish("error", {"Message": str(e)})
+            self.cancel(broadcast)
+            return
+
+        # The output is complete, new subscribers can replay it until the last leaves
+        if event is None:
+            broadcast.future = None
+            broadcast.done = True
+            broadcast.publish("done")
+            return
+
+        context = event.context
+        if "data" not in context:
+            return
+        payload = {
+            "id": broadcast.count,
+            "stream": context.get("stream"),
+            "rank": context.get("rank"),
+            "data": context["data"],
+        }
+        broadcast.add(payload)
+        broadcast.publish("output", payload)
+
+    def stats(self):
+        return {
+            "subscribers": self.subscribers,
+            "jobs": len(self.jobs),
+            "running": self.thread is not None,
+        }
+
+
+output_streams = OutputStreams(
+    queue_size=settings.output_stream_queue_size,
+    history=settings.output_stream_history,
+)
+
+
+def parse_last_event_id(value):
+    """
+    Parse the id of the last event a client saw (-1 means start at the beginning)
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+
+async def server_sent_events(subscriber):
+    """
+    Format subscriber events as server sent events, with keepalive pings.
+    """
+    try:
+        while True:
+            kind, payload = await subscriber.next(settings.output_stream_keepalive)
+            if kind == "ping":
+                yield ": ping\n\n"
+                continue
+            if kind == "output":
+                yield f"id: {payload['id']}\nevent: output\ndata: {json.dumps(payload)}\n\n"
+                continue
+
+            # done, error, or overflow end the stream
+            yield f"event: {kind}\ndata: {json.dumps(payload or {})}\n\n"
+            break
+    except asyncio.CancelledError:
+        pass
+    finally:
+        output_streams.unsubscribe(subscriber)
@@ -0,0 +1,122 @@
+import collections
+import copy
+import json
+import threading
+
+import app.library.flux as flux_cli
+from app.core.config import settings
+
+# Overrides that can be patched onto a prepared job (the rest change resources)
+patch_params = ["command", "option_flags", "envars", "workdir", "runtime"]
+
+
+def merge_params(params, overrides):
+    """
+    Merge template parameters with overrides (environment variables are combined)
+    """
+    merged = dict(params)
+    merged.update(overrides)
+    if params.get("envars") and overrides.get("envars"):
+        merged["envars"] = {**params["envars"], **overrides["envars"]}
+    return merged
+
+
+def copy_job(fluxjob):
+    """
+    Copy a prepared job, sharing the parts a submit does not change.
+
+    A submit patches the command, shell options, and system attributes (e.g.,
+    cwd, duration, and user), so only those are copied. The environment (the
+    largest part) is shared, and replaced (not changed) when a submit adds to it.
+    """
+    job = copy.copy(fluxjob)
+    jobspec = dict(fluxjob.jobspec)
+    jobspec["tasks"] = [dict(task) for task in jobspec["tasks"]]
+    attributes = jobspec["attributes"] = dict(jobspec["attributes"])
+    system = attributes["system"] = dict(attributes.get("system", {}))
+    if "shell" in system:
+        shell = system["shell"] = dict(system["shell"])
+        shell["options"] = copy.deepcopy(shell.get("options", {}))
+    job.jobspec = jobspec
+    return job
+
+
+class TemplateCache:
+    """
+    Prepared base jobs for job templates, by name and version.
+
+    Building a jobspec shell splits the command and copies the server
+    environment, so the base job of a template is prepared once, and each
+    submit gets a copy (see copy_job) with only the overridden fields patched in. A template
+    that is registered again has a new version and is prepared again.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, template):
+        """
+        Get a copy of the prepared base job for a template (database) object.
+        """
+        with self.lock:
+            entry = self.jobs.get(template.name)
+            if entry is not None and entry[0] == template.version:
+                self.jobs.move_to_end(template.name)
+                self.hits += 1
+                return copy_job(entry[1])
+            self.misses += 1
+
+        params = json.loads(template.params)
+        kwargs, envars, runtime = flux_cli.get_submit_kwargs(params)
+        fluxjob = flux_cli.prepare_job(
+            None, kwargs, runtime=runtime, workdir=params.get("workdir"), envars=envars
+        )
+        with self.lock:
+            self.jobs[template.name] = (template.version, fluxjob)
+            self.jobs.move_to_end(template.name)
+            while len(self.jobs) > self.size:
+                self.jobs.popitem(last=False)
+        return copy_job(fluxjob)
+
+    def prepare(self, template, user, overrides=None):
+        """
+        Validate and prepare a job from a template, returning (fluxjob, errors).
+        """
+        overrides = overrides or {}
+        params = json.loads(template.params)
+        merged = merge_params(params, overrides)
+        kwargs, envars, runtime = flux_cli.get_submit_kwargs(merged)
+        errors = flux_cli.validate_submit_kwargs(kwargs, envars=envars, runtime=runtime)
+        if errors:
+            return None, errors
+
+        try:
+            # Overrides that change resources need a new jobspec
+            if any(key not in patch_params for key in overrides):
+                fluxjob = flux_cli.prepare_job(
+                    user,
+                    kwargs,
+                    runtime=runtime,
+                    workdir=merged.get("workdir"),
+                    envars=envars,
+                )
+            else:
+                fluxjob = flux_cli.patch_job(self.get(template), user, overrides)
+        except Exception as e:
+            return None, [str(e)]
+        return fluxjob, []
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "templates": len(self.jobs),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+template_cache = TemplateCache(size=settings.template_cache_size)
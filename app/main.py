@@ -1,14 +1,18 @@
 import logging
 import os
 import sys
+import time
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
+import app.library.metrics as metrics
 from app.core.logging import init_loggers
 from app.db.base import Base
-from app.db.session import engine
+from app.db.session import engine, get_outdated_tables
 from app.routers import api, views
 
 init_loggers()
@@ -20,7 +24,59 @@ try:
 except Exception:
     pass
 
-app = FastAPI()
+# A table from an earlier version would fail every write (e.g., of job history)
+try:
+    outdated = get_outdated_tables(engine, Base.metadata)
+except Exception:
+    outdated = {}
+if outdated:
+    tables = "; ".join(f"{k} (missing {', '.join(v)})" for k, v in outdated.items())
+    sys.exit(
+        f"The database has tables from an earlier version: {tables}. "
+        "Migrate it with alembic, or remove it to start again."
+    )
+
+try:
+    import flux  # noqa
+except ImportError:
+    sys.exit("Cannot import flux. Make sure flux Python bindings are available.")
+
+from app.library.flux import output_executor  # noqa
+from app.library.handles import HandleTimeout, handles, output_handles  # noqa
+from app.library.history import job_history  # noqa
+from app.library.jobcache import job_cache  # noqa
+from app.library.resources import resource_cache  # noqa
+from app.library.signer import signer  # noqa
+from app.library.streams import output_streams  # noqa
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Connect to the flux instance once on startup, and disconnect on shutdown.
+    """
+    try:
+        handles.open()
+    except Exception:
+        sys.exit(
+            "Cannot find flux instance! Ensure you have run flux start or similar."
+        )
+    job_history.start()
+    job_cache.start()
+    resource_cache.start()
+    output_streams.start()
+    yield
+    output_streams.stop()
+    resource_cache.stop()
+    signer.close()
+    job_cache.stop()
+    job_history.stop()
+    output_executor.shutdown(wait=False, cancel_futures=True)
+    output_handles.close()
+    handles.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 here = os.path.dirname(os.path.abspath(__file__))
 root = os.path.dirname(here)
@@ -37,11 +93,17 @@ app.mount("/data", StaticFiles(directory=data_root), name="data")
 app.include_router(views.router)
 app.include_router(views.auth_views_router)
 app.include_router(api.router)
+app.include_router(api.metrics_router)
 
-try:
-    import flux
-except ImportError:
-    sys.exit("Cannot import flux. Make sure flux Python bindings are available.")
+
+@app.exception_handler(HandleTimeout)
+async def handle_timeout(request: Request, exc: HandleTimeout):
+    """
+    All Flux handles are busy, so the client should try again (soon)
+    """
+    return JSONResponse(
+        content={"Message": str(exc)}, status_code=503, headers={"Retry-After": "1"}
+    )
 
 
 @app.middleware("http")
@@ -52,12 +114,23 @@ async def load_app_data(request: Request, call_next):
     # Save the app root and app directory root (here)
     app.here = here
     app.root = root
+    return await call_next(request)
 
-    # Use a common flux executor
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    """
+    Count requests and time them, by method and route (the path template).
+    """
+    start = time.perf_counter()
+    status = 500
     try:
-        app.handle = flux.Flux()
-    except Exception:
-        sys.exit(
-            "Cannot find flux instance! Ensure you have run flux start or similar."
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = getattr(request.scope.get("route"), "path", "unknown")
+        metrics.requests.inc(request.method, route, str(status))
+        metrics.request_seconds.observe(
+            time.perf_counter() - start, request.method, route
         )
-    return await call_next(request)
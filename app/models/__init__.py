@@ -1,2 +1,3 @@
 from .job import Job  # noqa
+from .template import JobTemplate  # noqa
 from .user import User  # noqa
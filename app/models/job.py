@@ -1,12 +1,47 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    UniqueConstraint,
+)
 from sqlalchemy.orm import relationship
 
 from app.db.base_class import Base
 
 
 class Job(Base):
-    id = Column(Integer, primary_key=True, index=True)
+    # Flux job ids repeat across instances, so the key is our own
+    pk = Column(Integer, primary_key=True)
+
+    # The Flux job id, and the instance it ran in (see JobHistory.instance)
+    id = Column(Integer, index=True, nullable=False)
+    instance = Column(String, nullable=False, default="")
     name = Column(String, index=True)
     output = Column(String, index=True)
     owner_id = Column(Integer, ForeignKey("user.id"))
     owner = relationship("User", back_populates="jobs")
+
+    # The submitting user name (also without auth) and system userid
+    user_name = Column(String, nullable=True)
+    userid = Column(Integer, nullable=True)
+
+    # A sha256 of the submit jobspec, to find repeated submissions
+    jobspec_hash = Column(String, nullable=True)
+    t_submit = Column(Float, nullable=True)
+
+    # Filled in when the job is inactive (state and result are flux constants)
+    state = Column(Integer, nullable=True, index=True)
+    result = Column(Integer, nullable=True)
+    success = Column(Boolean, nullable=True)
+    waitstatus = Column(Integer, nullable=True)
+    t_inactive = Column(Float, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("instance", "id", name="uq_job_instance_id"),
+        Index("ix_job_t_submit_id", "t_submit", "id"),
+        Index("ix_job_owner_t_submit_id", "owner_id", "t_submit", "id"),
+    )
@@ -0,0 +1,13 @@
+from sqlalchemy import Column, ForeignKey, Integer, String
+
+from app.db.base_class import Base
+
+
+class JobTemplate(Base):
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, index=True, nullable=False)
+
+    # Submit parameters (json), and a version that changes when they do
+    params = Column(String, nullable=False)
+    version = Column(Integer, default=1, nullable=False)
+    owner_id = Column(Integer, ForeignKey("user.id"), nullable=True)
@@ -1,39 +1,63 @@
 import asyncio
+import json
 import os
 from datetime import timedelta
 
-import flux.job
-import flux.resource
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, Request, WebSocket, WebSocketDisconnect, status
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from jose import jwt
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
 import app.core.security as security
 import app.library.flux as flux_cli
 import app.library.helpers as helpers
 import app.library.launcher as launcher
+import app.library.metrics as metrics
 import app.routers.depends as deps
+import app.schemas as schemas
 from app.core.config import settings
+from app.crud import job as crud_job
+from app.crud import template as crud_template
 from app.crud import user as crud_user
+from app.crud.user import user_cache
 from app.library.auth import alert_auth
+from app.library.details import etag_matches, job_details
+from app.library.handles import HandleTimeout, handles, output_handles
+from app.library.history import job_history
+from app.library.jobcache import job_cache
+from app.library.output import output_cache, output_index
+from app.library.owners import owner_index
+from app.library.resources import resource_cache
+from app.library.signer import signer
+from app.library.streams import (
+    output_streams,
+    parse_last_event_id,
+    server_sent_events,
+    stream_names,
+)
+from app.library.templates import template_cache
 
 # Print (hidden message) to give status of auth
 alert_auth()
 router = APIRouter(prefix=f"/{settings.api_version}", tags=["jobs"])
 no_auth_router = APIRouter(prefix=f"/{settings.api_version}", tags=["jobs"])
 
+# Prometheus expects metrics at /metrics (without the api version)
+metrics_router = APIRouter(tags=["metrics"])
+
 
 templates = Jinja2Templates(directory="templates/")
 user_auth = Depends(deps.get_current_active_user) if settings.require_auth else None
+metrics_auth = Depends(deps.get_metrics_access) if settings.require_auth else None
 
 denied_response = JSONResponse(content={"Message": "Denied"}, status_code=400)
 
 
 @router.post("/token")
-async def login(request: Request, db: Session = Depends(deps.get_db)):
+async def login(request: Request, db: AsyncSession = Depends(deps.get_db)):
     """
     This is the API endpoint to request an authentication token.
 
@@ -60,7 +84,7 @@ async def login(request: Request, db: Session = Depends(deps.get_db)):
     if credentials["scope"] != "token":
         return denied_response
 
-    user = crud_user.authenticate(
+    user = await crud_user.authenticate(
         db, user_name=credentials["user"], password=credentials["pass"]
     )
     if not user:
@@ -91,83 +115,197 @@ async def service_stop(user=Depends(deps.get_current_active_superuser)):
     os.system("flux shutdown")
 
 
-@router.get("/jobs/search")
-async def jobs_listing(request: Request, user=user_auth):
+def get_service_stats():
     """
-    Jobslist is intended to be used by the server to render data tables
-
-    Since this is specific to jquery datables, we don't document.
+    Statistics about the server internals (e.g., the flux handle pool).
     """
-    start = request.query_params.get("start")
-    length = request.query_params.get("length")
-    draw = request.query_params.get("draw") or 1
-    query = request.query_params.get("search[value]") or request.query_params.get(
-        "search"
+    return jsonable_encoder(
+        {
+            "handles": handles.stats(),
+            "output_handles": output_handles.stats(),
+            "jobs": job_cache.stats(),
+            "output": output_index.stats(),
+            "output_cache": output_cache.stats(),
+            "streams": output_streams.stats(),
+            "signer": signer.stats(),
+            "templates": template_cache.stats(),
+            "auth": security.credential_cache.stats(),
+            "users": user_cache.stats(),
+            "history": job_history.stats(),
+            "owners": owner_index.stats(),
+            "details": job_details.stats(),
+            "resources": resource_cache.stats(),
+        }
     )
 
-    # If we have a query, filter to those that have in the name
-    jobs = list(flux_cli.list_jobs_detailed(user=user).values())
-    total = len(jobs)
 
-    # Now filter
-    if query:
-        jobs = flux_cli.query_jobs(jobs, query)
+@router.get("/service/stats")
+async def service_stats(user=user_auth):
+    """
+    Get statistics about the server internals (e.g., the flux handle pool).
+    """
+    return JSONResponse(content=get_service_stats(), status_code=200)
 
-    # If we are filtering to a range
-    if start and int(start) < len(jobs):
-        jobs = jobs[int(start) :]
 
-    # Do we have a length?
-    if length and int(length) < len(jobs):
-        jobs = jobs[0 : int(length)]
+@metrics_router.get("/metrics")
+async def get_metrics(user=metrics_auth):
+    """
+    Metrics (and service statistics) for Prometheus, for the worker that answers.
+
+    Every worker keeps its own values, so each scrape sees one worker.
+    """
+    content = metrics.render(get_service_stats())
+    return Response(content=content, media_type=metrics.content_type)
+
+
+@router.get("/jobs/search")
+async def jobs_listing(request: Request, user=user_auth):
+    """
+    Jobslist is intended to be used by the server to render data tables
+
+    Since this is specific to jquery datables, we don't document.
+    """
+    params = request.query_params
+    start = helpers.get_int_arg(params, "start") or 0
+    length = helpers.get_int_arg(params, "length")
+    draw = params.get("draw") or 1
+    query = params.get("search[value]") or params.get("search")
+    order = helpers.get_datatables_order(params)
+
+    # Only the visible page is materialized, counts come from the records
+    try:
+        jobs, total, filtered = await run_in_threadpool(
+            flux_cli.search_jobs,
+            user=user,
+            query=query,
+            start=start,
+            length=length,
+            order=order,
+        )
+    except ValueError as e:
+        return JSONResponse(content={"Message": str(e)}, status_code=400)
     return JSONResponse(
-        content={
-            "data": jobs,
-            "draw": draw,
-            "recordsTotal": total,
-            "recordsFiltered": len(jobs),
-        },
+        content=jsonable_encoder(
+            {
+                "data": jobs,
+                "draw": draw,
+                "recordsTotal": total,
+                "recordsFiltered": filtered,
+            }
+        ),
         status_code=200,
     )
 
 
 @router.get("/jobs")
 async def list_jobs(
-    details: bool = False, limit=None, listing: bool = False, user=user_auth
+    details: bool = False,
+    limit=None,
+    listing: bool = False,
+    cursor: str = None,
+    since: float = None,
+    until: float = None,
+    state: str = None,
+    user=user_auth,
 ):
     """
     List flux jobs associated with the handle.
+
+    Jobs are ordered newest first. When a limit is reached, the cursor for the
+    next page is returned (as "next", and in the X-Next-Cursor header).
     """
     payload = {"details": details, "limit": limit, "listing": listing}
+    limit = helpers.get_int_arg(payload, "limit")
 
     # Does the requester want details - in dict or listing form?
     print(payload)
-    if helpers.has_boolean_arg(payload, "details"):
-        # Job limit (only relevant for details)
-        limit = helpers.get_int_arg(payload, "limit")
-
-        jobs = flux_cli.list_jobs_detailed(limit=limit, user=user)
-        if helpers.has_boolean_arg(payload, "listing"):
-            jobs = list(jobs.values())
+    details = helpers.has_boolean_arg(payload, "details")
+    try:
+        jobs, next_cursor = await run_in_threadpool(
+            flux_cli.list_jobs_page,
+            user=user,
+            limit=limit,
+            cursor=cursor,
+            since=since,
+            until=until,
+            state=state,
+            attrs=flux_cli.job_attrs if details else None,
+        )
+    except ValueError as e:
+        return JSONResponse(content={"Message": str(e)}, status_code=400)
+
+    if details:
+        jobs = [flux_cli.format_job(job) for job in jobs]
+        if not helpers.has_boolean_arg(payload, "listing"):
+            jobs = {job["id"]: job for job in jobs}
+        jobs = jsonable_encoder(jobs)
     else:
-        listing = flux_cli.list_jobs(user=user)
-        jobs = jsonable_encoder({"jobs": listing.get_jobs()})
-    return JSONResponse(content=jobs, status_code=200)
+        jobs = jsonable_encoder({"jobs": jobs, "next": next_cursor})
 
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return JSONResponse(content=jobs, status_code=200, headers=headers)
 
-@router.get("/nodes")
-async def list_nodes(user=user_auth):
+
+@router.get("/jobs/history")
+async def list_job_history(
+    limit: int = 100,
+    cursor: str = None,
+    db: AsyncSession = Depends(deps.get_db),
+    user=user_auth,
+):
     """
-    List nodes known to the Flux handle.
+    List jobs submit through the server (and how they ended) from the database.
+
+    This history is kept when the broker forgets jobs (or restarts). Jobs are
+    newest first, and users that are not a superuser only see their own.
     """
-    from app.main import app
+    if limit < 1:
+        return JSONResponse(
+            content={"Message": "The limit must be at least 1."}, status_code=400
+        )
+    try:
+        before = flux_cli.decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return JSONResponse(content={"Message": str(e)}, status_code=400)
 
-    rpc = flux.resource.list.resource_list(app.handle)
-    listing = rpc.get()
-    nodes = jsonable_encoder(
-        {"nodes": list({str(node) for node in listing.up.nodelist})}
+    owner_id = user.id if user and not user.is_superuser else None
+    jobs = await crud_job.list_history(
+        db, owner_id=owner_id, before=before, limit=limit
+    )
+    jobs = [schemas.Job.model_validate(job, from_attributes=True) for job in jobs]
+    next_cursor = None
+    if len(jobs) == limit:
+        next_cursor = flux_cli.encode_cursor(
+            {"t_submit": jobs[-1].t_submit, "id": jobs[-1].id}
+        )
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return JSONResponse(
+        content=jsonable_encoder({"jobs": jobs, "next": next_cursor}),
+        status_code=200,
+        headers=headers,
     )
-    return JSONResponse(content=nodes, status_code=200)
+
+
+@router.get("/nodes")
+async def list_nodes(details: bool = False, user=user_auth):
+    """
+    List nodes known to the Flux handle.
+
+    Nodes that are up are listed by name, or with details all nodes with
+    their cores, gpus, and state (up, down, drained, or allocated).
+    """
+    inventory = await run_in_threadpool(resource_cache.get)
+    if details:
+        nodes = inventory
+    else:
+        nodes = {
+            "nodes": [
+                x["name"]
+                for x in inventory["nodes"]
+                if x["state"] in ["up", "allocated"]
+            ]
+        }
+    return JSONResponse(content=jsonable_encoder(nodes), status_code=200)
 
 
 @router.post("/jobs/{jobid}/cancel")
@@ -175,7 +313,7 @@ async def cancel_job(jobid, user=user_auth):
     """
     Cancel a running flux job
     """
-    message, return_code = flux_cli.cancel_job(jobid, user)
+    message, return_code = await run_in_threadpool(flux_cli.cancel_job, jobid, user)
     return JSONResponse(
         content={"Message": message, "id": jobid}, status_code=return_code
     )
@@ -203,8 +341,6 @@ async def submit_job(
     include everything in this function instead of having separate
     functions.
     """
-    from app.main import app
-
     # This can bork if no payload is provided
     if not command:
         return JSONResponse(
@@ -251,62 +387,403 @@ async def submit_job(
             )
             print(f"Prepared flux job {fluxjob}")
             # This handles either a single/multi user case
-            flux_future = flux_cli.submit_job(app.handle, fluxjob, user=user)
+            jobid = await run_in_threadpool(flux_cli.submit, fluxjob, user=user)
+        except HandleTimeout:
+            raise
         except Exception as e:
             result = jsonable_encoder(
                 {"Message": "There was an issue submitting that job.", "Error": str(e)}
             )
             return JSONResponse(content=result, status_code=400)
-        jobid = flux_future.get_id()
         result = jsonable_encoder({"Message": "Job submit.", "id": jobid})
 
     # If we get down here, either launcher derived or submit
     return JSONResponse(content=result, status_code=200)
 
 
+@router.post("/jobs/submit/batch")
+async def submit_job_batch(request: Request, user=user_auth):
+    """
+    Submit many jobs in one request.
+
+    The body is a json array (or one json object per line) of jobs, each with
+    the same parameters as a single submit. Each job is validated on its own,
+    and the response has an id or errors for each job, in order.
+    """
+    try:
+        specs = flux_cli.parse_batch(await request.body())
+    except (ValueError, UnicodeDecodeError) as e:
+        return JSONResponse(
+            content={"Message": f"Cannot parse batch of jobs: {e}"}, status_code=400
+        )
+    if not isinstance(specs, list) or not specs:
+        return JSONResponse(
+            content={"Message": "A list of one or more jobs is required."},
+            status_code=400,
+        )
+    if len(specs) > settings.submit_batch_size:
+        return JSONResponse(
+            content={
+                "Message": f"A batch can have at most {settings.submit_batch_size} jobs."
+            },
+            status_code=400,
+        )
+
+    # Submitting blocks on the broker, so don't hold up the event loop
+    results = await run_in_threadpool(flux_cli.submit_jobs, user, specs)
+    submitted = len([x for x in results if "id" in x])
+    result = jsonable_encoder(
+        {"Message": f"Submit {submitted} of {len(results)} jobs.", "jobs": results}
+    )
+    return JSONResponse(content=result, status_code=200)
+
+
+@router.post("/templates")
+async def create_template(
+    template: schemas.JobTemplateCreate,
+    db: AsyncSession = Depends(deps.get_db),
+    user=user_auth,
+):
+    """
+    Register (or replace) a named job template.
+
+    A template takes the same parameters as a job submit, and jobs are
+    submit from it with only the parameters that differ.
+    """
+    params = template.dict(exclude_none=True, exclude={"name"})
+    kwargs, envars, runtime = flux_cli.get_submit_kwargs(params)
+    invalid_messages = flux_cli.validate_submit_kwargs(
+        kwargs, envars=envars, runtime=runtime
+    )
+    if invalid_messages:
+        return JSONResponse(
+            content={"Message": "Invalid template", "Errors": invalid_messages},
+            status_code=400,
+        )
+
+    # Only the owner (or a superuser) can replace a template
+    owner_id = user.id if user else None
+    any_owner = not user or bool(user.is_superuser)
+    saved = await crud_template.create_or_update(
+        db, name=template.name, params=params, owner_id=owner_id, any_owner=any_owner
+    )
+    if saved.owner_id != owner_id and not any_owner:
+        return denied_response
+    result = jsonable_encoder(
+        {
+            "Message": "Template registered.",
+            "name": saved.name,
+            "version": saved.version,
+        }
+    )
+    return JSONResponse(content=result, status_code=200)
+
+
+@router.get("/templates")
+async def list_templates(db: AsyncSession = Depends(deps.get_db), user=user_auth):
+    """
+    List job templates and their parameters.
+
+    Users that are not superusers only see the templates they registered.
+    """
+    if not user or user.is_superuser:
+        listing = await crud_template.get_multi(db, limit=None)
+    else:
+        listing = await crud_template.get_multi_by_owner(db, owner_id=user.id)
+    templates = [
+        {"name": x.name, "version": x.version, "params": json.loads(x.params)}
+        for x in listing
+    ]
+    return JSONResponse(
+        content=jsonable_encoder({"templates": templates}), status_code=200
+    )
+
+
+@router.post("/templates/{name}/submit")
+async def submit_template(
+    name: str,
+    overrides: schemas.JobTemplateSubmit = None,
+    db: AsyncSession = Depends(deps.get_db),
+    user=user_auth,
+):
+    """
+    Submit a job from a template, with (optional) parameters to override.
+
+    Users that are not superusers can only submit from templates they own
+    (another user's template is reported as missing).
+    """
+    template = await crud_template.get_by_name(db, name=name)
+    if template and user and not user.is_superuser and template.owner_id != user.id:
+        template = None
+    if not template:
+        return JSONResponse(
+            content={"Message": f"Template {name} does not exist."}, status_code=404
+        )
+
+    overrides = overrides.dict(exclude_none=True) if overrides else {}
+    fluxjob, errors = template_cache.prepare(template, user, overrides)
+    if errors:
+        return JSONResponse(
+            content={"Message": "Invalid submit request", "Errors": errors},
+            status_code=400,
+        )
+    try:
+        jobid = await run_in_threadpool(flux_cli.submit, fluxjob, user=user)
+    except HandleTimeout:
+        raise
+    except Exception as e:
+        result = jsonable_encoder(
+            {"Message": "There was an issue submitting that job.", "Error": str(e)}
+        )
+        return JSONResponse(content=result, status_code=400)
+    return JSONResponse(
+        content=jsonable_encoder({"Message": "Job submit.", "id": jobid}),
+        status_code=200,
+    )
+
+
 @router.get("/jobs/{jobid}")
-async def get_job(jobid, user=user_auth):
+async def get_job(request: Request, jobid, user=user_auth):
     """
     Get job info based on id.
+
+    The response has an ETag, and a request with a matching If-None-Match
+    header gets a 304 (Not Modified) without a body.
     """
-    info = flux_cli.get_job(jobid, user=user)
+    try:
+        flux_cli.parse_jobid(jobid)
+    except ValueError as e:
+        return JSONResponse(content={"Message": str(e)}, status_code=400)
+    info, etag = await run_in_threadpool(flux_cli.get_job_detail, jobid, user=user)
+    headers = {"ETag": etag} if etag else None
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers=headers)
     info = jsonable_encoder(info)
-    return JSONResponse(content=info, status_code=200)
+    return JSONResponse(content=info, status_code=200, headers=headers)
 
 
 @router.get("/jobs/{jobid}/output")
-async def get_job_output(jobid, user=user_auth):
+async def get_job_output(
+    request: Request,
+    jobid,
+    offset: int = 0,
+    limit: int = None,
+    tail: int = None,
+    user=user_auth,
+):
     """
     Get job output based on id.
+
+    Optionally ask for lines starting at an offset (up to a limit), or the
+    last (tail) lines. The response includes the next offset to ask for.
+    All of the output of a finished job is sent from the output cache as it
+    is (compressed) to a client that accepts gzip.
     """
-    lines = flux_cli.get_job_output(jobid, user=user)
+    try:
+        flux_cli.parse_jobid(jobid)
+    except ValueError as e:
+        return JSONResponse(content={"Message": str(e)}, status_code=400)
+    for name, value in [("offset", offset), ("limit", limit), ("tail", tail)]:
+        if value is not None and value < 0:
+            return JSONResponse(
+                content={"Message": f"{name} must be >= 0"}, status_code=400
+            )
+
+    if (
+        not offset
+        and limit is None
+        and tail is None
+        and accepts_gzip(request.headers.get("Accept-Encoding"))
+        and await run_in_threadpool(owner_index.can_access, jobid, user)
+    ):
+        data = await flux_cli.run_output(output_cache.read, jobid)
+        if data is not None:
+            return Response(
+                content=data,
+                media_type="application/json",
+                headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+            )
+
+    output = await flux_cli.run_output(
+        flux_cli.get_job_output_range,
+        jobid,
+        user=user,
+        offset=offset,
+        limit=limit,
+        tail=tail,
+    )
 
-    # We have output
-    if lines:
-        output = jsonable_encoder({"Output": lines})
-        return JSONResponse(content=output, status_code=200)
+    # We have output (or are paging through it)
+    if output["Output"] or offset:
+        return JSONResponse(content=jsonable_encoder(output), status_code=200)
 
     info = jsonable_encoder(
-        {"Message": "The output does not exist yet, or the jobid is incorrect."}
+        {
+            "Message": "The output does not exist yet, or the jobid is incorrect.",
+            "next_offset": output["next_offset"],
+        }
     )
     return JSONResponse(content=info, status_code=200)
 
 
-async def streamer(generator):
+def accepts_gzip(value):
+    """
+    Determine if an Accept-Encoding header accepts gzip.
+    """
+    for encoding in (value or "").split(","):
+        name, _, params = encoding.partition(";")
+        if name.strip().lower() not in ["gzip", "*"]:
+            continue
+
+        # A quality of 0 means "not acceptable"
+        params = params.replace(" ", "")
+        try:
+            return not params.startswith("q=") or float(params[2:]) > 0
+        except ValueError:
+            return False
+    return False
+
+
+async def streamer(subscriber):
     """
     Helper function to stream output lines, break if cancelled.
     """
     try:
-        for line in generator:
-            yield line
+        while True:
+            kind, payload = await subscriber.next()
+            if kind != "output":
+                break
+            yield payload["data"]
     except asyncio.CancelledError:
         print("caught cancelled error")
+    finally:
+        output_streams.unsubscribe(subscriber)
 
 
 @router.get("/jobs/{jobid}/output/stream")
-async def get_job_stream_output(jobid):
+async def get_job_stream_output(jobid, user=user_auth):
     """
     Non-blocking variant to stream output until control+c.
     """
-    stream = flux_cli.stream_job_output(jobid)
-    return StreamingResponse(streamer(stream))
+    try:
+        flux_cli.parse_jobid(jobid)
+    except ValueError as e:
+        return JSONResponse(content={"Message": str(e)}, status_code=400)
+    if not await run_in_threadpool(owner_index.can_access, jobid, user):
+        return JSONResponse(
+            content={"Message": f"You do not own job {jobid}."}, status_code=400
+        )
+    subscriber = output_streams.subscribe(jobid)
+    return StreamingResponse(streamer(subscriber))
+
+
+def parse_streams(stream):
+    """
+    Parse a comma separated list of output streams (stdout, stderr) to follow.
+    """
+    if not stream:
+        return None
+    streams = [x.strip() for x in stream.split(",") if x.strip()]
+    for name in streams:
+        if name not in stream_names:
+            raise ValueError(
+                f"{name} is not a known stream, choices are {stream_names}"
+            )
+    return streams
+
+
+@router.get("/jobs/{jobid}/output/events")
+async def get_job_output_events(
+    request: Request, jobid, stream: str = None, user=user_auth
+):
+    """
+    Follow job output as server sent events.
+
+    Each output event has an id, and a client that reconnects with the
+    Last-Event-ID header (or last_event_id parameter) resumes after it.
+    """
+    try:
+        flux_cli.parse_jobid(jobid)
+        streams = parse_streams(stream)
+    except ValueError as e:
+        return JSONResponse(content={"Message": str(e)}, status_code=400)
+    if not await run_in_threadpool(owner_index.can_access, jobid, user):
+        return JSONResponse(
+            content={"Message": f"You do not own job {jobid}."}, status_code=400
+        )
+    after = parse_last_event_id(
+        request.headers.get("Last-Event-ID")
+        or request.query_params.get("last_event_id")
+    )
+    subscriber = output_streams.subscribe(jobid, streams=streams, after=after)
+    return StreamingResponse(
+        server_sent_events(subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/jobs/{jobid}/output/ws")
+async def job_output_websocket(
+    websocket: WebSocket,
+    jobid,
+    stream: str = None,
+    last_event_id: int = -1,
+    user=Depends(deps.get_websocket_user),
+):
+    """
+    Follow job output over a websocket.
+
+    Messages are json with an "event" (output, ping, done, error, or overflow)
+    and for output, the id, stream, rank, and data.
+    """
+    if settings.require_auth and not user:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    try:
+        flux_cli.parse_jobid(jobid)
+        streams = parse_streams(stream)
+    except ValueError as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=str(e))
+        return
+    if not await run_in_threadpool(owner_index.can_access, jobid, user):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    subscriber = output_streams.subscribe(jobid, streams=streams, after=last_event_id)
+
+    # Read from the client, so we notice when it closes (or goes away)
+    closed = asyncio.ensure_future(receive_until_closed(websocket))
+    try:
+        while True:
+            event = asyncio.ensure_future(
+                subscriber.next(settings.output_stream_keepalive)
+            )
+            await asyncio.wait([event, closed], return_when=asyncio.FIRST_COMPLETED)
+            if not event.done():
+                event.cancel()
+                break
+            kind, payload = event.result()
+            await websocket.send_json({"event": kind, **(payload or {})})
+            if kind not in ["output", "ping"]:
+                await websocket.close()
+                break
+    except WebSocketDisconnect:
+        pass
+    finally:
+        closed.cancel()
+        output_streams.unsubscribe(subscriber)
+
+
+async def receive_until_closed(websocket):
+    """
+    Read (and ignore) messages from a websocket client until it closes.
+    """
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+    except (WebSocketDisconnect, RuntimeError):
+        return
@@ -1,38 +1,55 @@
-from typing import Generator
+import secrets
+from typing import AsyncGenerator, Optional
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, WebSocket, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt
 from pydantic import ValidationError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app import crud, models, schemas
+from app import crud, schemas
 from app.core import security
 from app.core.config import settings
-from app.db.session import SessionLocal
+from app.db.session import AsyncSessionLocal
 
 login_url = f"{settings.api_version}/login/access-token"
 reusable_oauth2 = OAuth2PasswordBearer(tokenUrl=login_url)
+optional_oauth2 = OAuth2PasswordBearer(tokenUrl=login_url, auto_error=False)
 
 
-def get_db() -> Generator:
+async def get_db() -> AsyncGenerator:
     """
     Get the database in a context so we can then close it.
     """
-    try:
-        db = SessionLocal()
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-def get_current_user(
-    db: Session = Depends(get_db), token: str = Depends(reusable_oauth2)
-) -> models.User:
+async def get_token_user(
+    db: AsyncSession, token: str
+) -> Optional[schemas.UserIdentity]:
+    """
+    Get the user for a jwt token, or None if it is invalid or expired.
+    """
+    try:
+        payload = jwt.decode(
+            token, settings.secret_key, algorithms=[security.ALGORITHM]
+        )
+        token_data = schemas.TokenPayload(**payload)
+    except (jwt.JWTError, ValidationError):
+        return None
+    return await crud.user.get_identity(db, id=token_data.sub)
+
+
+async def get_current_user(
+    db: AsyncSession = Depends(get_db), token: str = Depends(reusable_oauth2)
+) -> schemas.UserIdentity:
     """
     Get the current user (via the token from the jwt)
 
-    And fail if not authenticated or expired.
+    And fail if not authenticated or expired. The user comes from the
+    per-worker user cache when it can, so most requests don't query the
+    database (the session is only connected when used).
     """
     try:
         payload = jwt.decode(
@@ -44,15 +61,36 @@ def get_current_user(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Could not validate credentials",
         )
-    user = crud.user.get(db, id=token_data.sub)
+    user = await crud.user.get_identity(db, id=token_data.sub)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
 
+async def get_websocket_user(
+    websocket: WebSocket, db: AsyncSession = Depends(get_db)
+) -> Optional[schemas.UserIdentity]:
+    """
+    Get the active user for a websocket, or None if not authenticated.
+
+    Browsers cannot set headers on a websocket, so the bearer token can
+    also be provided as a "token" query parameter.
+    """
+    token = websocket.query_params.get("token")
+    header = websocket.headers.get("Authorization")
+    if not token and header:
+        token = header.split(" ")[-1].strip()
+    if not token:
+        return None
+    user = await get_token_user(db, token)
+    if not user or not crud.user.is_active(user):
+        return None
+    return user
+
+
 def get_current_active_user(
-    current_user: models.User = Depends(get_current_user),
-) -> models.User:
+    current_user: schemas.UserIdentity = Depends(get_current_user),
+) -> schemas.UserIdentity:
     """
     Get the currently active user.
     """
@@ -62,8 +100,8 @@ def get_current_active_user(
 
 
 def get_current_active_superuser(
-    current_user: models.User = Depends(get_current_user),
-) -> models.User:
+    current_user: schemas.UserIdentity = Depends(get_current_user),
+) -> schemas.UserIdentity:
     """
     Get the currently active superuser.
     """
@@ -72,3 +110,24 @@ def get_current_active_superuser(
             status_code=400, detail="The user doesn't have enough privileges"
         )
     return current_user
+
+
+async def get_metrics_access(
+    db: AsyncSession = Depends(get_db), token: str = Depends(optional_oauth2)
+) -> Optional[schemas.UserIdentity]:
+    """
+    Allow reading metrics with the metrics token (e.g., for Prometheus), or as
+    an active user.
+    """
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if settings.metrics_token and secrets.compare_digest(
+        token.encode("utf-8"), settings.metrics_token.encode("utf-8")
+    ):
+        return None
+    user = await get_current_user(db=db, token=token)
+    return get_current_active_user(user)
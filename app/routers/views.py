@@ -2,10 +2,11 @@ from datetime import timedelta
 
 import flux.job
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
 import app.core.security as security
 import app.library.flux as flux_cli
@@ -16,6 +17,13 @@ from app.core.config import settings
 from app.crud import user as crud_user
 from app.forms import SubmitForm
 from app.library.auth import check_auth
+from app.library.output import snapshot_timeout
+from app.library.owners import owner_index
+from app.library.streams import (
+    output_streams,
+    parse_last_event_id,
+    server_sent_events,
+)
 
 # These views never have auth!
 router = APIRouter(tags=["views"])
@@ -36,12 +44,13 @@ user_auth = Depends(check_auth) if settings.require_auth else None
 
 @router.post(f"/{deps.login_url}")
 async def login(
-    form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(deps.get_db)
+    form_data: OAuth2PasswordRequestForm = Depends(),
+    db: AsyncSession = Depends(deps.get_db),
 ):
     """
     This is the API endpoint to request an authentication token.
     """
-    user = crud_user.authenticate(
+    user = await crud_user.authenticate(
         db, user_name=form_data.username, password=form_data.password
     )
     if not user:
@@ -73,14 +82,8 @@ async def home(request: Request):
 # List jobs
 @auth_views_router.get("/jobs", response_class=HTMLResponse)
 async def jobs_table(request: Request, user=user_auth):
-    jobs = list(flux_cli.list_jobs_detailed(user=user).values())
-    return templates.TemplateResponse(
-        "jobs/jobs.html",
-        {
-            "request": request,
-            "jobs": jobs,
-        },
-    )
+    # The table is populated (one page at a time) via /v1/jobs/search
+    return templates.TemplateResponse("jobs/jobs.html", {"request": request})
 
 
 @router.get("/logout")
@@ -112,18 +115,26 @@ async def logout(request: Request, response: Response):
     operation_id="job_info",
 )
 async def job_info(request: Request, jobid, msg=None, user=user_auth):
-    job = flux_cli.get_job(jobid, user=user)
+    try:
+        flux_cli.parse_jobid(jobid)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    job = await run_in_threadpool(flux_cli.get_job, jobid, user=user)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {jobid} was not found.")
 
     # If we have a message, add to messages
     messages = [msg] if msg else []
 
-    # If not completed, ask info to return after a second of waiting
+    # If completed, ensure we get all the logs!
     if job["state"] == "INACTIVE":
-        info = flux_cli.get_job_output(jobid, user=user)
+        info = await flux_cli.get_job_output_async(jobid, user=user)
 
-    # Otherwise ensure we get all the logs!
+    # Otherwise render the output so far, and the page follows the rest
     else:
-        info = flux_cli.get_job_output(jobid, user=user, delay=1)
+        info = await flux_cli.get_job_output_async(
+            jobid, user=user, delay=snapshot_timeout
+        )
     return templates.TemplateResponse(
         "jobs/job.html",
         {
@@ -136,6 +147,27 @@ async def job_info(request: Request, jobid, msg=None, user=user_auth):
     )
 
 
+# Follow the output of a job (for the job page)
+@auth_views_router.get("/job/{jobid}/output/events")
+async def job_output_events(request: Request, jobid, user=user_auth):
+    try:
+        flux_cli.parse_jobid(jobid)
+    except ValueError:
+        return Response(status_code=400)
+    if not await run_in_threadpool(owner_index.can_access, jobid, user):
+        return Response(status_code=404)
+    after = parse_last_event_id(
+        request.headers.get("Last-Event-ID")
+        or request.query_params.get("last_event_id")
+    )
+    subscriber = output_streams.subscribe(jobid, after=after)
+    return StreamingResponse(
+        server_sent_events(subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # Submit a job via a form
 @auth_views_router.get("/jobs/submit", response_class=HTMLResponse)
 async def submit_job(request: Request, user=user_auth):
@@ -152,7 +184,7 @@ async def submit_job(request: Request, user=user_auth):
 async def cancel_job(request: Request, jobid, user=user_auth):
     from app.main import app
 
-    message, _ = flux_cli.cancel_job(jobid, user=user)
+    message, _ = await run_in_threadpool(flux_cli.cancel_job, jobid, user=user)
     url = app.url_path_for(name="job_info", jobid=jobid) + "?msg=" + message
     return RedirectResponse(url=url)
 
@@ -176,7 +208,7 @@ async def submit_job_post(request: Request, user=user_auth):
                 launcher.launch(form.kwargs, workdir=form.workdir, user=user)
             )
         else:
-            return submit_job_helper(request, form, user=user)
+            return await run_in_threadpool(submit_job_helper, request, form, user=user)
     else:
         print("🍒 Submit form is NOT valid!")
     return templates.TemplateResponse(
@@ -195,16 +227,13 @@ def submit_job_helper(request, form, user):
     """
     A helper to submit a flux job (not a launcher)
     """
-    from app.main import app
-
     # Submit the job and return the ID, but allow for error
     # Prepare the flux job! We don't support envars here yet
     try:
         fluxjob = flux_cli.prepare_job(
             user, form.kwargs, runtime=form.runtime, workdir=form.workdir
         )
-        flux_future = flux_cli.submit_job(app.handle, fluxjob, user=user)
-        jobid = flux_future.get_id()
+        jobid = flux_cli.submit(fluxjob, user=user)
         intid = flux.job.JobID(jobid)
         message = f"Your job was successfully submit! 🦊 <a target='_blank' style='color:magenta' href='/job/{intid}'>{jobid}</a>"
         return templates.TemplateResponse(
@@ -1,3 +1,4 @@
 from .job import Job, JobCreate, JobInDB, JobUpdate  # noqa
+from .template import JobTemplateCreate, JobTemplateSubmit  # noqa
 from .token import Token, TokenPayload  # noqa
-from .user import User, UserCreate, UserInDB, UserUpdate  # noqa
+from .user import User, UserCreate, UserIdentity, UserInDB, UserUpdate  # noqa
@@ -22,8 +22,18 @@ class JobUpdate(JobBase):
 # Properties shared by models stored in DB
 class JobInDBBase(JobBase):
     id: int
-    name: str
-    owner_id: int
+    instance: Optional[str] = None
+    name: Optional[str] = None
+    owner_id: Optional[int] = None
+    user_name: Optional[str] = None
+    userid: Optional[int] = None
+    jobspec_hash: Optional[str] = None
+    t_submit: Optional[float] = None
+    state: Optional[int] = None
+    result: Optional[int] = None
+    success: Optional[bool] = None
+    waitstatus: Optional[int] = None
+    t_inactive: Optional[float] = None
 
     class Config:
         orm_mode = True
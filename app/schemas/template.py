@@ -0,0 +1,27 @@
+from typing import Dict, List, Optional, Union
+
+from pydantic import BaseModel
+
+
+# Submit parameters a template can set, and a template submit can override
+class JobTemplateBase(BaseModel):
+    command: Optional[Union[str, List[str]]] = None
+    num_tasks: Optional[int] = None
+    cores_per_task: Optional[int] = None
+    gpus_per_task: Optional[int] = None
+    num_nodes: Optional[int] = None
+    exclusive: Optional[bool] = None
+    option_flags: Optional[Union[str, Dict[str, str]]] = None
+    envars: Optional[Dict[str, str]] = None
+    workdir: Optional[str] = None
+    runtime: Optional[int] = None
+
+
+# Properties to receive via API on creation
+class JobTemplateCreate(JobTemplateBase):
+    name: str
+
+
+# Properties to receive via API on submit
+class JobTemplateSubmit(JobTemplateBase):
+    pass
@@ -35,3 +35,9 @@ class User(UserInDBBase):
 # Additional properties stored in DB
 class UserInDB(UserInDBBase):
     hashed_password: str
+
+
+# Properties kept in memory to authenticate requests
+class UserIdentity(UserBase):
+    id: int
+    user_name: str
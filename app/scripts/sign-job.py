@@ -2,16 +2,64 @@
 
 # See https://github.com/flux-framework/flux-core/blob/master/t/t2404-job-exec-multiuser.t#L48
 # for an example of using this. This should be run with flux python, as done in library/flux.py
+#
+# With --serve, stay running and sign many jobs: each request and response is a
+# 4 byte (big endian) length followed by that many bytes of json. A request is
+# {"userid": <int>, "payload": <jobspec>} and the response {"signed": <J>} or
+# {"error": <message>}. See app/library/signer.py for the other side.
+import json
+import struct
 import sys
 
 from flux.security import SecurityContext
 
+header = struct.Struct(">I")
+
+
+def read_frame(stream):
+    """
+    Read one length prefixed frame, or None at the end of the stream.
+    """
+    size = stream.read(header.size)
+    if len(size) < header.size:
+        return None
+    return json.loads(stream.read(header.unpack(size)[0]))
+
+
+def write_frame(stream, message):
+    data = json.dumps(message).encode("utf-8")
+    stream.write(header.pack(len(data)) + data)
+    stream.flush()
+
+
+def serve(ctx):
+    """
+    Sign requests from stdin until it is closed.
+    """
+    while True:
+        request = read_frame(sys.stdin.buffer)
+        if request is None:
+            return
+        try:
+            signed = ctx.sign_wrap_as(
+                int(request["userid"]), request["payload"], mech_type="munge"
+            )
+            write_frame(sys.stdout.buffer, {"signed": signed.decode("utf-8")})
+        except Exception as e:
+            write_frame(sys.stdout.buffer, {"error": str(e)})
+
+
 if len(sys.argv) < 2:
     print("Usage: {0} USERID".format(sys.argv[0]))
+    print("       {0} --serve".format(sys.argv[0]))
     sys.exit(1)
 
-userid = int(sys.argv[1])
 ctx = SecurityContext()
+if sys.argv[1] == "--serve":
+    serve(ctx)
+    sys.exit(0)
+
+userid = int(sys.argv[1])
 payload = sys.stdin.read()
 
 print(ctx.sign_wrap_as(userid, payload, mech_type="munge").decode("utf-8"))
@@ -3,6 +3,7 @@ import os
 import sys
 import time
 
+import pytest
 from fastapi.testclient import TestClient
 
 here = os.path.abspath(os.path.dirname(__file__))
@@ -12,6 +13,7 @@ sys.path.insert(0, root)
 
 from jose import jwt  # noqa
 
+from app.library.jobcache import job_cache  # noqa
 from app.main import app  # noqa
 
 client = TestClient(app)
@@ -22,6 +24,15 @@ root = os.path.dirname(here)
 sys.path.insert(0, root)
 
 
+@pytest.fixture(scope="module", autouse=True)
+def lifespan():
+    """
+    Run the app lifespan (e.g., start the job cache) around the tests.
+    """
+    with client:
+        yield
+
+
 def get_basic_auth(username, password):
     auth_str = "%s:%s" % (username, password)
     return base64.b64encode(auth_str.encode("utf-8")).decode("utf-8")
@@ -154,6 +165,136 @@ def test_cancel_job():
     # TODO we don't have way to actually verify that cancel happened
 
 
+def test_metrics():
+    """
+    Test that metrics are served for Prometheus (with a token if auth is required)
+    """
+    response = client.get("/metrics")
+    if test_auth:
+        assert response.status_code == 401
+        authenticate("/v1/service/stats")
+        response = client.get(
+            "/metrics", headers={"Authorization": f"Bearer {access_token}"}
+        )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "flux_restful_http_requests_total" in response.text
+    assert "flux_restful_jobs_submitted_total" in response.text
+
+
+def test_list_nodes():
+    """
+    Test listing nodes, with and without details
+    """
+    response = authenticate("/v1/nodes")
+    nodes = response.json()["nodes"]
+    assert nodes
+
+    response = authenticate("/v1/nodes", params={"details": True})
+    result = response.json()
+    assert result["cores"] > 0
+    for node in result["nodes"]:
+        assert node["state"] in ["up", "down", "drained", "allocated"]
+        assert node["cores"] > 0
+    assert set(nodes) <= {node["name"] for node in result["nodes"]}
+
+
+def test_job_etag():
+    """
+    Test that polling a job with its ETag gets a 304 (Not Modified)
+    """
+    response = authenticate(
+        "/v1/jobs/submit", method="post", params={"command": "sleep 5"}
+    )
+    jobid = response.json()["id"]
+    response = authenticate(f"/v1/jobs/{jobid}")
+    assert response.json()["id"] == jobid
+    assert "etag" in response.headers
+
+    headers = {"If-None-Match": response.headers["etag"]}
+    if test_auth:
+        headers["Authorization"] = f"Bearer {access_token}"
+    response = client.get(f"/v1/jobs/{jobid}", headers=headers)
+    assert response.status_code == 304
+    assert not response.content
+
+
+def test_submit_batch():
+    """
+    Test that a batch of jobs is submit, with errors for invalid jobs.
+    """
+    jobs = [
+        {"command": "sleep 1"},
+        {"command": "sleep 1", "option_flags": {"ompi": "openmpi@5"}},
+        {"num_tasks": 1},
+        {"command": "sleep 1", "runtime": "5"},
+        {"command": "sleep 1", "num_nodes": "abc"},
+    ]
+    response = authenticate("/v1/jobs/submit/batch", method="post", json=jobs)
+    result = response.json()
+    assert len(result["jobs"]) == 5
+    assert "id" in result["jobs"][0] and "id" in result["jobs"][1]
+    assert "Errors" in result["jobs"][2]
+
+    # Types are coerced per job, and a bad job only gets errors
+    assert "id" in result["jobs"][3]
+    assert "Errors" in result["jobs"][4]
+
+    # An empty batch is invalid
+    authenticate("/v1/jobs/submit/batch", method="post", json=[], expected_status=400)
+
+
+def test_job_history():
+    """
+    Test that submit jobs are recorded in the job history.
+    """
+    response = authenticate(
+        "/v1/jobs/submit", method="post", params={"command": "sleep 1"}
+    )
+    jobid = response.json()["id"]
+
+    # History is written in the background
+    for _ in range(10):
+        response = authenticate("/v1/jobs/history", params={"limit": 5})
+        if jobid in [job["id"] for job in response.json()["jobs"]]:
+            break
+        time.sleep(0.5)
+    jobs = {job["id"]: job for job in response.json()["jobs"]}
+    assert jobid in jobs
+    assert jobs[jobid]["name"] == "sleep"
+
+    authenticate("/v1/jobs/history", params={"limit": 0}, expected_status=400)
+
+
+def test_job_templates():
+    """
+    Test registering a job template, and submitting with overrides.
+    """
+    template = {"name": "sleeper", "command": "sleep 1", "num_tasks": 1}
+    response = authenticate("/v1/templates", method="post", json=template)
+    assert response.json()["name"] == "sleeper"
+
+    response = authenticate("/v1/templates")
+    names = [x["name"] for x in response.json()["templates"]]
+    assert "sleeper" in names
+
+    response = authenticate(
+        "/v1/templates/sleeper/submit", method="post", json={"command": "sleep 2"}
+    )
+    assert "id" in response.json()
+
+    # Overrides are validated, and the template must exist
+    authenticate(
+        "/v1/templates/sleeper/submit",
+        method="post",
+        json={"runtime": -1},
+        expected_status=400,
+    )
+    authenticate(
+        "/v1/templates/doesnotexist/submit", method="post", json={}, expected_status=404
+    )
+
+
 def test_submit_option_flags():
     """
     Test that option flags are parsed.
@@ -193,6 +334,21 @@ def test_job_output():
     lines = res.json()
     assert "Output" in lines
     assert "pancakes 🥞️🥞️🥞️\n" in lines["Output"]
+    total = lines["next_offset"]
+    assert total == len(lines["Output"])
+
+    # Ask for the last line, and for lines past the end
+    res = authenticate(f"/v1/jobs/{jobid}/output", params={"tail": 1})
+    lines = res.json()
+    assert lines["Output"] == ["pancakes 🥞️🥞️🥞️\n"]
+    assert lines["next_offset"] == total
+    res = authenticate(f"/v1/jobs/{jobid}/output", params={"offset": total})
+    assert res.json()["Output"] == []
+    authenticate(f"/v1/jobs/{jobid}/output", params={"tail": -1}, expected_status=400)
+
+    # A job id that is not one is a bad request
+    authenticate("/v1/jobs/pancakes/output", expected_status=400)
+    authenticate("/v1/jobs/pancakes/output/events", expected_status=400)
 
 
 def test_job_query():
@@ -210,14 +366,91 @@ def test_job_query():
     total = result["recordsTotal"]
     assert len(result["data"]) == total
 
-    # Ask to start at 2 (should be one less record)
+    # Ask to start at 2 (should be one less record, but nothing filtered)
     response = authenticate("/v1/jobs/search", params={"start": 1})
     result = response.json()
-    assert result["recordsFiltered"] == total - 1
+    assert len(result["data"]) == total - 1
+    assert result["recordsFiltered"] == total
     assert result["recordsTotal"] == total
 
     # Ask for specific length
     response = authenticate("/v1/jobs/search", params={"length": 3})
     result = response.json()
-    assert result["recordsFiltered"] == 3
+    assert len(result["data"]) == 3
+    assert result["recordsFiltered"] == total
     assert result["recordsTotal"] == total
+
+    # Sort by id, in both directions, as data tables would ask
+    for direction in ["asc", "desc"]:
+        response = authenticate(
+            "/v1/jobs/search",
+            params={
+                "order[0][column]": 0,
+                "order[0][dir]": direction,
+                "columns[0][data]": "id",
+            },
+        )
+        ids = [job["id"] for job in response.json()["data"]]
+        assert ids == sorted(ids, reverse=direction == "desc")
+
+    # Search with a field qualified query, and a bare term matches a prefix
+    response = authenticate("/v1/jobs/search", params={"search": "name:slee*"})
+    result = response.json()
+    assert result["recordsFiltered"] >= 5
+    assert all(job["name"] == "sleep" for job in result["data"])
+    response = authenticate("/v1/jobs/search", params={"search": "slee"})
+    assert response.json()["recordsFiltered"] >= result["recordsFiltered"]
+
+    # An unknown field is a plain term (that matches nothing here)
+    response = authenticate("/v1/jobs/search", params={"search": "pancakes:yes"})
+    assert response.json()["recordsFiltered"] == 0
+
+
+def test_list_jobs_since(monkeypatch):
+    """
+    Test listing jobs that changed since a time, from the job cache and the broker
+    """
+    start = time.time() - 60
+    authenticate("/v1/jobs/submit", method="post", params={"command": "sleep 1"})
+    for _ in range(50):
+        if job_cache.ready:
+            break
+        time.sleep(0.1)
+    assert job_cache.ready
+
+    # The job cache covers everything, and then it covers nothing (the broker)
+    for covers in [True, False]:
+        monkeypatch.setattr(job_cache, "covers", lambda **kwargs: covers)
+        result = authenticate("/v1/jobs", params={"since": start}).json()
+        assert result["jobs"]
+        future = time.time() + 3600
+        result = authenticate("/v1/jobs", params={"since": future}).json()
+        assert not result["jobs"]
+
+
+def test_list_jobs_cursor():
+    """
+    Test walking the job listing one page at a time with a cursor
+    """
+    for _ in range(3):
+        authenticate("/v1/jobs/submit", method="post", params={"command": "sleep 1"})
+    response = authenticate("/v1/jobs")
+    expected = [job["id"] for job in response.json()["jobs"]]
+    assert len(expected) >= 3
+
+    # Pages of two jobs, until there is no next cursor
+    ids = []
+    params = {"limit": 2}
+    while True:
+        result = authenticate("/v1/jobs", params=params).json()
+        assert len(result["jobs"]) <= 2
+        ids += [job["id"] for job in result["jobs"]]
+        if not result["next"]:
+            break
+        params["cursor"] = result["next"]
+    assert ids == expected
+
+    # Filter by state, and an unknown state is an error
+    result = authenticate("/v1/jobs", params={"state": "inactive,run"}).json()
+    assert all(job["state"] in [16, 64] for job in result["jobs"])
+    authenticate("/v1/jobs", params={"state": "pancakes"}, expected_status=400)